@@ -8,29 +8,40 @@ https://github.com/canonical/kubeflow-volumes-operator
 """
 
 import logging
+import re
 from pathlib import Path
+from typing import Dict, List
 
 import lightkube
-from charmed_kubeflow_chisme.components import (
-    CharmReconciler,
-    ContainerFileTemplate,
-    KubernetesComponent,
-    LeadershipGateComponent,
-    SdiRelationBroadcasterComponent,
-)
+from charmed_kubeflow_chisme.components import LeadershipGateComponent
 from charmed_kubeflow_chisme.kubernetes import create_charm_default_labels
 from charms.kubeflow_dashboard.v0.kubeflow_dashboard_links import (
     DashboardLink,
     KubeflowDashboardLinksRequirer,
 )
-from charms.loki_k8s.v1.loki_push_api import LogForwarder
-from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
+from lightkube.generic_resource import create_namespaced_resource
 from lightkube.models.core_v1 import ServicePort
-from lightkube.resources.core_v1 import ServiceAccount
-from lightkube.resources.rbac_authorization_v1 import ClusterRole, ClusterRoleBinding
+from lightkube.resources.core_v1 import Namespace, Service, ServiceAccount
+from lightkube.resources.rbac_authorization_v1 import (
+    ClusterRole,
+    ClusterRoleBinding,
+    RoleBinding,
+)
 from ops import CharmBase, main
 
-from components.pebble_components import KubeflowVolumesInputs, KubeflowVolumesPebbleService
+from components.charm_reconciler import ComponentInputs, IncrementalCharmReconciler
+from components.config_components import ConfigValidationGateComponent
+from components.kubernetes_components import DeleteTarget, KubeflowVolumesKubernetesComponent
+from components.kubernetes_drift import KubernetesDriftCharmEvents, KubernetesDriftWatcher
+from components.log_forwarder import KubeflowVolumesLogForwarder
+from components.pebble_components import (
+    GUNICORN_CONFIG_DESTINATION_PATH,
+    KubeflowVolumesInputs,
+    KubeflowVolumesPebbleService,
+)
+from components.sdi_components import KubeflowVolumesSdiRelationBroadcasterComponent
+from components.service_patch import CachedKubernetesServicePatch
+from components.template_cache import CachedContainerFileTemplate, TemplateCache
 
 logger = logging.getLogger(__name__)
 TEMPLATES_PATH = Path("src/templates")
@@ -38,16 +49,22 @@ K8S_RESOURCE_FILES = [TEMPLATES_PATH / "auth_manifests.yaml.j2"]
 
 CONFIG_YAML_TEMPLATE_FILE = TEMPLATES_PATH / "viewer-spec.yaml"
 CONFIG_YAML_DESTINATION_PATH = "/etc/config/viewer-spec.yaml"
-
-DASHBOARD_LINKS = [
-    DashboardLink(
-        text="Volumes",
-        link="/volumes/",
-        type="item",
-        icon="device:storage",
-        location="menu",
-    )
-]
+GUNICORN_CONFIG_TEMPLATE_FILE = TEMPLATES_PATH / "gunicorn_config.py"
+# Cache of the compiled and rendered templates, relative to the charm directory.  It is kept next
+# to the unit state of ops (.unit-state.db): Juju only replaces the files of the charm on upgrade,
+# so both outlive it.  Cached entries are keyed by the hash of the template sources, so the ones
+# of the previous charm revision are never read, and are pruned as new ones are written.
+TEMPLATE_CACHE_PATH = ".template-cache"
+# Number of update-status events after which all the components are executed, to repair and
+# report changes that the cheap drift checks of update-status do not see
+FULL_RECONCILE_INTERVAL = 12
+SHARD_CONFIG = ["shard-namespaces", "shard-namespace-selector"]
+# Path prefix of the web app behind the ingress; in shard mode, followed by the application name
+APP_PREFIX = "/volumes"
+# Kubernetes namespace names are RFC 1123 (DNS) labels
+NAMESPACE_NAME_PATTERN = re.compile(r"[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?")
+# Viewers spawned by the web app for the PVCs of the users
+PVCViewer = create_namespaced_resource("kubeflow.org", "v1alpha1", "PVCViewer", "pvcviewers")
 
 
 class KubeflowVolumesOperator(CharmBase):
@@ -56,6 +73,8 @@ class KubeflowVolumesOperator(CharmBase):
     https://github.com/canonical/kubeflow-volumes-operator
     """
 
+    on = KubernetesDriftCharmEvents()
+
     def __init__(self, *args):
         super().__init__(*args)
 
@@ -63,53 +82,80 @@ class KubeflowVolumesOperator(CharmBase):
         self.kubeflow_dashboard_sidebar = KubeflowDashboardLinksRequirer(
             charm=self,
             relation_name="dashboard-links",
-            dashboard_links=DASHBOARD_LINKS,
+            dashboard_links=self._get_dashboard_links(),
+            refresh_event=self.on.config_changed,
         )
 
         # expose web app's port
         http_port = ServicePort(int(self.model.config["port"]), name="http")
-        self.service_patcher = KubernetesServicePatch(
+        self.service_patcher = CachedKubernetesServicePatch(
             self, [http_port], service_name=f"{self.model.app.name}"
         )
 
-        # Charm logic
-        self.charm_reconciler = CharmReconciler(self)
+        self._lightkube_client = lightkube.Client()
+        self._template_cache = TemplateCache(self.charm_dir / TEMPLATE_CACHE_PATH)
+
+        # Charm logic, where each component is only executed when its inputs changed.
+        # update-status only executes the components whose inputs or Pebble health drifted, and
+        # all of them every FULL_RECONCILE_INTERVAL update-status.
+        self.charm_reconciler = IncrementalCharmReconciler(
+            self, fast_update_status=True, full_reconcile_interval=FULL_RECONCILE_INTERVAL
+        )
         self.leadership_gate = self.charm_reconciler.add(
             component=LeadershipGateComponent(
                 charm=self,
                 name="leadership-gate",
             ),
             depends_on=[],
+            inputs=ComponentInputs(leadership=True),
+        )
+        self.shard_config_gate = self.charm_reconciler.add(
+            component=ConfigValidationGateComponent(
+                charm=self,
+                name="config:shard",
+                validate=self._validate_shard_config,
+            ),
+            depends_on=[],
+            inputs=ComponentInputs(config=SHARD_CONFIG),
         )
 
+        auth_resource_types = {ClusterRole, ClusterRoleBinding, RoleBinding, ServiceAccount}
+        auth_labels = create_charm_default_labels(self.app.name, self.model.name, scope="auth")
         self.kubernetes_resources = self.charm_reconciler.add(
-            component=KubernetesComponent(
+            component=KubeflowVolumesKubernetesComponent(
                 charm=self,
                 name="kubernetes:auth",
                 resource_templates=K8S_RESOURCE_FILES,
-                krh_resource_types={ClusterRole, ClusterRoleBinding, ServiceAccount},
-                krh_labels=create_charm_default_labels(
-                    self.app.name, self.model.name, scope="auth"
+                krh_resource_types=auth_resource_types,
+                krh_labels=auth_labels,
+                context_callable=self._get_auth_manifests_context,
+                lightkube_client=self._lightkube_client,
+                teardown_targets=self._get_teardown_targets,
+                template_cache=self._template_cache,
+            ),
+            depends_on=[self.leadership_gate, self.shard_config_gate],
+            # the namespaces matching the shard selector are part of the inputs, so that the
+            # namespaces labelled after the last execution get their RoleBindings
+            inputs=ComponentInputs(
+                config=SHARD_CONFIG,
+                leadership=True,
+                state=lambda: (
+                    self._get_auth_manifests_context() if self.unit.is_leader() else None
                 ),
-                context_callable=lambda: {"app_name": self.app.name, "namespace": self.model.name},
-                lightkube_client=lightkube.Client(),
             ),
-            depends_on=[self.leadership_gate],
         )
 
         self.ingress_relation = self.charm_reconciler.add(
-            component=SdiRelationBroadcasterComponent(
+            component=KubeflowVolumesSdiRelationBroadcasterComponent(
                 charm=self,
                 name="relation:ingress",
                 relation_name="ingress",
-                data_to_send={
-                    "prefix": "/volumes",
-                    "rewrite": "/",
-                    "service": self.model.app.name,
-                    "port": int(self.model.config["port"]),
-                },
+                data_to_send=self._get_ingress_data(),
+            ),
+            depends_on=[self.leadership_gate, self.shard_config_gate],
+            inputs=ComponentInputs(
+                config=["port", *SHARD_CONFIG], relations=["ingress"], leadership=True
             ),
-            depends_on=[self.leadership_gate],
         )
 
         self.kubeflow_volumes_container = self.charm_reconciler.add(
@@ -119,25 +165,201 @@ class KubeflowVolumesOperator(CharmBase):
                 container_name="kubeflow-volumes",
                 service_name="kubeflow-volumes",
                 files_to_push=[
-                    ContainerFileTemplate(
+                    CachedContainerFileTemplate(
                         source_template_path=CONFIG_YAML_TEMPLATE_FILE,
                         destination_path=CONFIG_YAML_DESTINATION_PATH,
+                        template_cache=self._template_cache,
+                    ),
+                    CachedContainerFileTemplate(
+                        source_template_path=GUNICORN_CONFIG_TEMPLATE_FILE,
+                        destination_path=GUNICORN_CONFIG_DESTINATION_PATH,
+                        template_cache=self._template_cache,
                     ),
                 ],
                 inputs_getter=lambda: KubeflowVolumesInputs(
                     APP_SECURE_COOKIES=self.model.config["secure-cookies"],
                     BACKEND_MODE=self.model.config["backend-mode"],
                     VOLUME_VIEWER_IMAGE=self.model.config["volume-viewer-image"],
+                    ACCESS_LOG_ENABLED=self.model.config["access-log"],
+                    ACCESS_LOG_SAMPLE_RATE=self.model.config["access-log-sample-rate"],
+                    ACCESS_LOG_EXCLUDE_PATHS=self.model.config["access-log-exclude-paths"],
+                    ACCESS_LOG_FORMAT=self.model.config["access-log-format"],
+                    APP_PREFIX=self.app_prefix,
                 ),
             ),
             depends_on=[
                 self.leadership_gate,
                 self.kubernetes_resources,
             ],
+            inputs=ComponentInputs(
+                config=[
+                    "secure-cookies",
+                    "backend-mode",
+                    "volume-viewer-image",
+                    "access-log",
+                    "access-log-sample-rate",
+                    "access-log-exclude-paths",
+                    "access-log-format",
+                    *SHARD_CONFIG,
+                ],
+                containers=["kubeflow-volumes"],
+            ),
         )
 
+        # optionally watch the auth resources, repairing the ones edited or deleted in the cluster.
+        # Observes remove before the reconciler, so that the teardown is not reported as drift.
+        self.drift_watcher = KubernetesDriftWatcher(
+            self,
+            reconciler=self.charm_reconciler,
+            component_item=self.kubernetes_resources,
+            labels=auth_labels,
+            resource_types=auth_resource_types,
+        )
         self.charm_reconciler.install_default_event_handlers()
-        self._logging = LogForwarder(charm=self)
+        # label the forwarded logs with their format, so LogQL can parse JSON access logs
+        self._logging = KubeflowVolumesLogForwarder(
+            charm=self,
+            extra_labels={"log_format": self.model.config["access-log-format"]},
+            refresh_event=self.on.config_changed,
+            one_per_app=self.model.config["log-forwarding-one-per-app"],
+        )
+
+    @property
+    def shard_mode(self) -> bool:
+        """Whether this application serves only a subset of the namespaces in the cluster."""
+        return bool(
+            self.model.config["shard-namespaces"] or self.model.config["shard-namespace-selector"]
+        )
+
+    @property
+    def app_prefix(self) -> str:
+        """Path prefix of the web app, distinct for each shard so that shards share an ingress."""
+        return f"{APP_PREFIX}/{self.app.name}" if self.shard_mode else APP_PREFIX
+
+    def _get_dashboard_links(self) -> List[DashboardLink]:
+        """Returns the links added to the kubeflow-dashboard sidebar, to this web app."""
+        return [
+            DashboardLink(
+                text=f"Volumes ({self.app.name})" if self.shard_mode else "Volumes",
+                link=f"{self.app_prefix}/",
+                type="item",
+                icon="device:storage",
+                location="menu",
+            )
+        ]
+
+    def _validate_shard_config(self):
+        """Checks the shard options, before any component uses them.
+
+        Raises:
+            ValueError: if `shard-namespaces` lists a name that is not a valid namespace name, or
+                        `shard-namespace-selector` is not a valid label selector.
+        """
+        invalid_namespaces = [
+            namespace
+            for namespace in parse_namespaces(self.model.config["shard-namespaces"])
+            if not NAMESPACE_NAME_PATTERN.fullmatch(namespace)
+        ]
+        if invalid_namespaces:
+            raise ValueError(
+                f"Invalid shard-namespaces: {', '.join(invalid_namespaces)} (expected lowercase "
+                "alphanumerics and '-', of at most 63 characters)"
+            )
+        try:
+            parse_label_selector(self.model.config["shard-namespace-selector"])
+        except ValueError as e:
+            raise ValueError(f"Invalid shard-namespace-selector: {e}") from e
+
+    def _get_shard_namespaces(self) -> List[str]:
+        """Returns the sorted list of namespaces served by this application in shard mode.
+
+        The namespaces listed in `shard-namespaces` are combined with the namespaces matching the
+        `shard-namespace-selector` label selector.  Listed namespaces that do not exist (yet) are
+        left out, as the RoleBindings cannot be created in them; they are served once created.
+        """
+        namespaces = set(parse_namespaces(self.model.config["shard-namespaces"]))
+        if namespaces:
+            existing = {
+                namespace.metadata.name for namespace in self._lightkube_client.list(Namespace)
+            }
+            if missing := namespaces - existing:
+                logger.warning(f"Shard namespaces not found: {', '.join(sorted(missing))}")
+            namespaces &= existing
+        selector = parse_label_selector(self.model.config["shard-namespace-selector"])
+        if selector:
+            namespaces.update(
+                namespace.metadata.name
+                for namespace in self._lightkube_client.list(Namespace, labels=selector)
+            )
+        return sorted(namespaces)
+
+    def _get_auth_manifests_context(self) -> dict:
+        """Returns the context used to render the auth manifests."""
+        shard_mode = self.shard_mode
+        return {
+            "app_name": self.app.name,
+            "namespace": self.model.name,
+            "shard_mode": shard_mode,
+            "shard_namespaces": self._get_shard_namespaces() if shard_mode else [],
+        }
+
+    def _get_teardown_targets(self) -> List[DeleteTarget]:
+        """Returns the resources deleted along with the auth resources on remove.
+
+        These are the Service patched by CachedKubernetesServicePatch and, in shard mode, the
+        PVCViewers spawned by the web app in the namespaces of the shard.  The web app does not
+        label the PVCViewers, so outside of shard mode they cannot be told apart from the ones of
+        other applications, and are left to the owners of their namespaces.
+        """
+        targets = [DeleteTarget(Service, name=self.app.name, namespace=self.model.name)]
+        if self.shard_mode:
+            targets.extend(
+                DeleteTarget(PVCViewer, namespace=namespace)
+                for namespace in self._get_shard_namespaces()
+            )
+        return targets
+
+    def _get_ingress_data(self) -> dict:
+        """Returns the data sent over the ingress relation.
+
+        In shard mode, the web app is served under its own prefix, and the data also carries the
+        namespaces served by this application so that the ingress provider can route the requests
+        of each namespace to the right shard.
+        """
+        data = {
+            "prefix": self.app_prefix,
+            "rewrite": "/",
+            "service": self.model.app.name,
+            "port": int(self.model.config["port"]),
+        }
+        if self.shard_mode:
+            data["shard"] = {
+                "namespaces": parse_namespaces(self.model.config["shard-namespaces"]),
+                "namespace_selector": self.model.config["shard-namespace-selector"],
+            }
+        return data
+
+
+def parse_namespaces(value: str) -> List[str]:
+    """Returns the namespaces of a comma-separated string, ignoring empty entries."""
+    return [namespace.strip() for namespace in value.split(",") if namespace.strip()]
+
+
+def parse_label_selector(value: str) -> Dict[str, str]:
+    """Returns a `key=value[,key=value...]` label selector as a dict.
+
+    Raises:
+        ValueError: if any of the terms of the selector is not a `key=value` pair.
+    """
+    selector = {}
+    for term in value.split(","):
+        if not term.strip():
+            continue
+        key, sep, label_value = term.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"Invalid label selector term '{term}', expected 'key=value'.")
+        selector[key.strip()] = label_value.strip()
+    return selector
 
 
 if __name__ == "__main__":
@@ -0,0 +1,454 @@
+import dataclasses
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from charmed_kubeflow_chisme.components import CharmReconciler, Component, ComponentGraphItem
+from charmed_kubeflow_chisme.components.component_graph import ComponentGraph
+from charmed_kubeflow_chisme.components.pebble_component import PebbleComponent
+from ops import (
+    ActiveStatus,
+    CharmBase,
+    EventBase,
+    MaintenanceStatus,
+    PebbleReadyEvent,
+    StatusBase,
+    StoredState,
+    UpdateStatusEvent,
+)
+from ops.pebble import CheckStatus, ServiceStartup
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ComponentInputs:
+    """Declares the inputs a Component depends on, for IncrementalCharmReconciler.
+
+    Args:
+        config: the config options read by the Component
+        relations: the relations whose remote data is read by the Component
+        leadership: whether the Component behaves differently on the leader
+        containers: the containers the Component must be able to connect to
+        state: (optional) a callable returning the JSON-serializable runtime state read by the
+               Component outside of the model (eg: namespaces listed from the cluster).  Since
+               that may take API requests, it is only called on update-status, or if it was never
+               called before: other events reuse the last state it returned.
+    """
+
+    config: Sequence[str] = ()
+    relations: Sequence[str] = ()
+    leadership: bool = False
+    containers: Sequence[str] = ()
+    state: Optional[Callable[[], Any]] = None
+
+
+class StatusCachingComponentGraphItem(ComponentGraphItem):
+    """ComponentGraphItem reading the status of its Component at most once per reconcile.
+
+    The status of a Component is asked for by the Components depending on it and for the unit
+    status, and for some Components computing it takes API requests.
+
+    Args:
+        component: the Component to wrap
+        depends_on: the ComponentGraphItems this Component depends on
+        statuses: the statuses of the Components in the current reconcile, by name, shared by the
+                  items of a graph and cleared by the reconciler
+    """
+
+    def __init__(
+        self,
+        component: Component,
+        depends_on: Optional[List[ComponentGraphItem]] = None,
+        *,
+        statuses: Dict[str, StatusBase],
+    ):
+        super().__init__(component, depends_on)
+        self._statuses = statuses
+
+    def get_status(self) -> StatusBase:
+        """Returns the Status of this Component in the context of Components it depends_on."""
+        if not self.executed or self._inactive_prerequisites():
+            return super().get_status()
+        if self.name not in self._statuses:
+            self._statuses[self.name] = self.component.status
+        return self._statuses[self.name]
+
+
+class StatusCachingComponentGraph(ComponentGraph):
+    """ComponentGraph of StatusCachingComponentGraphItems, sharing a cache of statuses."""
+
+    def __init__(self):
+        super().__init__()
+        self.statuses: Dict[str, StatusBase] = {}
+
+    def add(
+        self,
+        component: Component,
+        depends_on: Optional[List[ComponentGraphItem]] = None,
+    ) -> ComponentGraphItem:
+        """Add a component to the graph, returning a ComponentGraphItem for this Component.
+
+        Args:
+            component: the Component to add to this execution graph
+            depends_on: the list of registered ComponentGraphItems that this Component depends on
+                        being Active before it should run.
+        """
+        name = component.name
+        if name in self.component_items:
+            raise ValueError(
+                f"Cannot add component {name} - component named {name} already exists."
+            )
+        self.component_items[name] = StatusCachingComponentGraphItem(
+            component, depends_on, statuses=self.statuses
+        )
+        self.status_prioritiser.add(name, lambda: self.component_items[name].status)
+        return self.component_items[name]
+
+
+class IncrementalCharmReconciler(CharmReconciler):
+    """CharmReconciler that only executes the Components whose inputs changed.
+
+    Components added with `inputs` are skipped when the fingerprint of their inputs is the one
+    recorded at their last successful (Active) execution, except PebbleComponents on the
+    pebble-ready event of their container (eg: after the container restarted with an empty
+    plan).  Components added without `inputs` are executed on every reconcile, as with
+    CharmReconciler.
+
+    The status of each Component is read at most once per reconcile, and skipped Components are
+    reported Active without being asked, since a recorded fingerprint stands for an Active
+    Component.  Components no longer Active for reasons outside of their inputs are found by the
+    update-status that executes all the Components.
+
+    All Components are executed on update-status, so that changes outside of the declared inputs
+    (eg: Kubernetes resources edited in the cluster) are still reconciled periodically, and after
+    an upgrade, since the new charm code may configure them differently.
+
+    With `fast_update_status`, update-status instead only checks cheap health signals: the inputs
+    of each Component against the fingerprint of its last successful execution, and the state of
+    the Pebble services and checks of the containers it declared.  Components are only executed
+    when these show drift, or when the unit is not Active.  Every `full_reconcile_interval`
+    update-status, all the Components are executed anyway, so that changes the health signals do
+    not show are still repaired and reported.
+    """
+
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        *args,
+        fast_update_status: bool = False,
+        full_reconcile_interval: int = 12,
+        **kwargs,
+    ):
+        """CharmReconciler that only executes the Components whose inputs changed.
+
+        Args:
+            charm: a CharmBase object to operate from this CharmReconciler
+            fast_update_status: if True, update-status only executes Components when their
+                                inputs or Pebble health show drift.
+            full_reconcile_interval: with fast_update_status, the number of update-status events
+                                     after which all the Components are executed.
+            *args: positional arguments of CharmReconciler
+            **kwargs: keyword arguments of CharmReconciler
+        """
+        super().__init__(charm, *args, component_graph=StatusCachingComponentGraph(), **kwargs)
+        if full_reconcile_interval < 1:
+            raise ValueError(
+                f"full_reconcile_interval must be at least 1 - got {full_reconcile_interval}."
+            )
+        self._stored.set_default(fingerprints={}, runtime_states={}, update_status_count=0)
+        self._inputs: Dict[str, ComponentInputs] = {}
+        # fingerprints of the Component inputs, computed once per event
+        self._fingerprints_event: Optional[str] = None
+        self._current_fingerprints: Dict[str, Optional[str]] = {}
+        self._fast_update_status = fast_update_status
+        self._full_reconcile_interval = full_reconcile_interval
+
+    def add(
+        self,
+        component: Component,
+        depends_on: Optional[List[ComponentGraphItem]] = None,
+        inputs: Optional[ComponentInputs] = None,
+    ) -> ComponentGraphItem:
+        """Add a component to the graph, returning a ComponentGraphItem for this Component.
+
+        Args:
+            component: the Component to add to this execution graph
+            depends_on: the list of registered ComponentGraphItems that this Component depends on
+                        being Active before it should run.
+            inputs: (optional) the inputs of the Component.  If None, the Component is executed on
+                    every reconcile.
+        """
+        component_item = super().add(component, depends_on)
+        if inputs is not None:
+            self._inputs[component.name] = inputs
+        return component_item
+
+    def install_default_event_handlers(self):
+        """Installs the CharmReconciler event handlers, and a full reconcile on upgrade-charm."""
+        super().install_default_event_handlers()
+        self._charm.framework.observe(self._charm.on.upgrade_charm, self._on_upgrade_charm)
+
+    def reconcile(self, event: EventBase, force: bool = False):
+        """Executes the components whose inputs changed, ordered by their dependencies.
+
+        Components are executed one after the other, since they read and write the ops model,
+        which is not thread-safe.  Components doing many Kubernetes API requests run these
+        concurrently themselves (see `bulk_apply`).
+
+        Args:
+            event: the event being handled
+            force: if True, executes all the components that are ready for execution
+        """
+        logger.info(f"Starting `execute_components` for event '{event.handle}'")
+
+        # Set all .executed=False, just in case this is not a fresh init of the Charm.
+        for component_graph_item in self._component_graph.component_items.values():
+            component_graph_item.executed = False
+        self._component_graph.statuses.clear()
+
+        for component_item in self._component_graph.yield_executable_component_items():
+            fingerprint, executed, status = self._execute_component(component_item, event, force)
+            if executed and fingerprint is not None:
+                self._record_execution(component_item.name, fingerprint, status)
+
+        logger.info("execute_components execution loop complete.")
+        self._update_charm_status()
+
+    def _execute_component(
+        self, component_item: ComponentGraphItem, event: EventBase, force: bool
+    ) -> Tuple[Optional[str], bool, Optional[StatusBase]]:
+        """Executes a component, unless its inputs did not change since its last success.
+
+        Returns:
+            The fingerprint of the inputs of the component, whether it was executed, and its
+            status after the execution (None if it failed).
+        """
+        fingerprint = self._get_fingerprint(component_item.name, event)
+        if (
+            not force
+            and fingerprint is not None
+            and self._stored.fingerprints.get(component_item.name) == fingerprint
+            and not _is_own_pebble_ready(component_item.component, event)
+        ):
+            logger.info(
+                f"Skipping component '{component_item.name}': its inputs did not change "
+                f"since its last successful execution"
+            )
+            # the fingerprint is only recorded when an execution left the component Active
+            self._component_graph.statuses[component_item.name] = ActiveStatus()
+            return fingerprint, False, None
+
+        logger.info(f"Executing component: '{component_item.name}'")
+        self._charm.unit.status = MaintenanceStatus(
+            f"Reconciling charm: executing component {component_item.name}"
+        )
+
+        # Execute the component and log any errors
+        try:
+            component_item.component.configure_charm(event)
+            status = component_item.component.get_status()
+            self._component_graph.statuses[component_item.name] = status
+            logger.info(
+                f"Execution for component '{component_item.name}' complete.  Component now has "
+                f"status '{status}'"
+            )
+        except Exception as err:
+            _ = err  # Suppress the lint about broad exceptions
+            msg = (
+                f"execute_components caught unhandled exception when executing "
+                f"configure_charm for {component_item.name}"
+            )
+            logger.error(msg, exc_info=True)
+            status = None
+        return fingerprint, True, status
+
+    def update_status(self, event: EventBase):
+        """Handler for an update-status event.  Updates charm with the aggregate status.
+
+        With fast_update_status, only executes the Components that drifted, if any, except every
+        full_reconcile_interval update-status, which executes them all.  Else, executes all the
+        Components when reconcile_on_update_status is set, whether their inputs changed or not.
+        """
+        if self._fast_update_status:
+            self._stored.update_status_count += 1
+            if self._stored.update_status_count % self._full_reconcile_interval == 0:
+                logger.info("update-status executes all the components periodically")
+                return self.reconcile(event, force=True)
+
+            drifted = self._get_drifted_components(event)
+            if not drifted and isinstance(self._charm.unit.status, ActiveStatus):
+                logger.info("update-status found no drift, skipping the reconcile")
+                return
+            logger.info(f"update-status found drift in components {drifted}, reconciling")
+            self._stored.fingerprints = {
+                name: fingerprint
+                for name, fingerprint in self._stored.fingerprints.items()
+                if name not in drifted
+            }
+            return self.reconcile(event)
+        if self._reconcile_on_update_status:
+            return self.reconcile(event, force=True)
+        self._component_graph.statuses.clear()
+        return super().update_status(event)
+
+    def invalidate(self, name: str):
+        """Forgets the last successful execution of a Component, so that it is executed again.
+
+        For changes to the state of a Component outside of its declared inputs (eg: drift of its
+        Kubernetes resources), the Component is executed by the next reconcile or update-status.
+        """
+        if name in self._stored.fingerprints:
+            self._stored.fingerprints = {
+                key: fingerprint
+                for key, fingerprint in self._stored.fingerprints.items()
+                if key != name
+            }
+
+    def _on_upgrade_charm(self, event: EventBase):
+        """Executes all the Components with the upgraded charm code."""
+        self._stored.fingerprints = {}
+        self.reconcile(event, force=True)
+
+    def _get_component_statuses(self) -> List[Tuple[str, StatusBase]]:
+        """Returns the Component statuses, forgetting the executions of the ones not Active.
+
+        A recorded fingerprint stands for a Component that is Active with these inputs, so the
+        Components found otherwise (eg: after a change in the cluster) are executed again by the
+        next reconcile.
+        """
+        statuses = super()._get_component_statuses()
+        for name, status in statuses:
+            if not isinstance(status, ActiveStatus):
+                self.invalidate(name)
+        return statuses
+
+    def _record_execution(self, name: str, fingerprint: str, status: Optional[StatusBase]):
+        """Records the fingerprint of a Component after an execution, if it succeeded."""
+        fingerprints = dict(self._stored.fingerprints)
+        if isinstance(status, ActiveStatus):
+            fingerprints[name] = fingerprint
+        else:
+            fingerprints.pop(name, None)
+        if fingerprints != dict(self._stored.fingerprints):
+            self._stored.fingerprints = fingerprints
+
+    def _get_drifted_components(self, event: EventBase) -> List[str]:
+        """Returns the Components whose inputs changed, or whose containers are not healthy.
+
+        Components added without `inputs` are not checked.
+        """
+        drifted = []
+        for name, inputs in self._inputs.items():
+            fingerprint = self._get_fingerprint(name, event)
+            if (
+                fingerprint is None
+                or self._stored.fingerprints.get(name) != fingerprint
+                or not all(
+                    self._is_container_healthy(container_name)
+                    for container_name in inputs.containers
+                )
+            ):
+                drifted.append(name)
+        return drifted
+
+    def _is_container_healthy(self, container_name: str) -> bool:
+        """Returns whether the enabled Pebble services of a container run and its checks are up."""
+        container = self._charm.unit.get_container(container_name)
+        if not container.can_connect():
+            return False
+        services_running = all(
+            service.is_running()
+            for service in container.get_services().values()
+            if service.startup == ServiceStartup.ENABLED
+        )
+        checks_up = all(
+            check.status == CheckStatus.UP for check in container.get_checks().values()
+        )
+        return services_running and checks_up
+
+    def _get_fingerprint(self, name: str, event: EventBase) -> Optional[str]:
+        """Returns the fingerprint of the inputs of a Component, computed once per event."""
+        if self._fingerprints_event != event.handle.path:
+            self._fingerprints_event = event.handle.path
+            self._current_fingerprints = {}
+        if name not in self._current_fingerprints:
+            self._current_fingerprints[name] = self._fingerprint(
+                name, read_state=isinstance(event, UpdateStatusEvent)
+            )
+        return self._current_fingerprints[name]
+
+    def _get_runtime_state(self, name: str, inputs: ComponentInputs, read_state: bool) -> Any:
+        """Returns the runtime state of a Component, read again only if `read_state` is set.
+
+        Raises:
+            Exception: any error of the `state` callable of the Component.
+        """
+        if inputs.state is None:
+            return None
+        if not read_state and name in self._stored.runtime_states:
+            return json.loads(self._stored.runtime_states[name])
+        runtime_state = json.dumps(inputs.state(), sort_keys=True)
+        if self._stored.runtime_states.get(name) != runtime_state:
+            self._stored.runtime_states = {**self._stored.runtime_states, name: runtime_state}
+        return json.loads(runtime_state)
+
+    def _fingerprint(self, name: str, read_state: bool = True) -> Optional[str]:
+        """Returns a fingerprint of the current inputs of a Component, if it declared them.
+
+        Args:
+            name: the name of the Component
+            read_state: whether the runtime state of the Component is read again, instead of
+                        reusing the last one read
+
+        Returns None if the Component declared no inputs, or if its runtime state is unavailable.
+        """
+        inputs = self._inputs.get(name)
+        if inputs is None:
+            return None
+
+        model = self._charm.model
+        try:
+            runtime_state = self._get_runtime_state(name, inputs, read_state)
+        except Exception as e:
+            # the Component is executed, and reports the error through its status
+            logger.warning(f"Failed to get the runtime state of component '{name}': {e}")
+            return None
+        state = {
+            "config": {key: model.config.get(key) for key in inputs.config},
+            "relations": {
+                relation_name: [
+                    {
+                        "id": relation.id,
+                        "app": relation.app.name if relation.app else None,
+                        "app_data": dict(relation.data[relation.app]) if relation.app else {},
+                        "units": {
+                            unit.name: dict(relation.data[unit])
+                            for unit in relation.units
+                            if unit.app != model.app
+                        },
+                    }
+                    for relation in model.relations[relation_name]
+                ]
+                for relation_name in inputs.relations
+            },
+            "leader": model.unit.is_leader() if inputs.leadership else None,
+            "containers": {
+                container_name: model.unit.get_container(container_name).can_connect()
+                for container_name in inputs.containers
+            },
+            "state": runtime_state,
+        }
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def _is_own_pebble_ready(component: Component, event: EventBase) -> bool:
+    """Returns whether an event is the pebble-ready event of the container of a PebbleComponent."""
+    return (
+        isinstance(component, PebbleComponent)
+        and isinstance(event, PebbleReadyEvent)
+        and event.workload.name == component.container_name
+    )
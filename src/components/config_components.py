@@ -0,0 +1,32 @@
+import logging
+from typing import Callable
+
+from charmed_kubeflow_chisme.components.component import Component
+from ops import ActiveStatus, BlockedStatus, StatusBase
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigValidationGateComponent(Component):
+    """Component that is Blocked while the charm's config is invalid.
+
+    Components depending on it are not executed until the config is fixed, so that an invalid
+    option is reported with a clear message instead of failing the components that use it.
+
+    Args:
+        validate: function raising ValueError, with a description of the problem, if the config
+                  is invalid
+    """
+
+    def __init__(self, *args, validate: Callable[[], None], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._validate = validate
+
+    def get_status(self) -> StatusBase:
+        """Returns Blocked with the description of the invalid config, if any, else Active."""
+        try:
+            self._validate()
+        except ValueError as e:
+            logger.warning(f"Invalid config: {e}")
+            return BlockedStatus(str(e))
+        return ActiveStatus()
@@ -0,0 +1,409 @@
+import dataclasses
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from charmed_kubeflow_chisme.components import KubernetesComponent
+from charmed_kubeflow_chisme.exceptions import ErrorWithStatus, GenericCharmRuntimeError
+from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler
+from charmed_kubeflow_chisme.lightkube.batch import delete_many
+from lightkube import Client
+from lightkube.core.exceptions import ApiError
+from lightkube.core.resource import NamespacedResource, Resource
+from lightkube.core.selector import build_selector
+from lightkube.generic_resource import load_in_cluster_generic_resources
+from lightkube.types import CascadeType
+from ops import BlockedStatus
+
+from components.template_cache import CachedKubernetesResourceHandler, TemplateCache
+
+logger = logging.getLogger(__name__)
+
+# Field manager of the server-side applies, the one used by the KubernetesResourceHandler
+FIELD_MANAGER = "lightkube"
+BULK_APPLY_MAX_WORKERS = 4
+BULK_APPLY_ATTEMPTS = 4
+# Delay before the first retry of a failed apply, doubled on every retry
+BULK_APPLY_BACKOFF = 0.5
+# Apply errors that are likely transient, along with server errors: throttling
+RETRIABLE_STATUS_CODES = {429}
+
+# Resources are applied in tiers, so that the resources referenced by others exist first
+APPLY_TIERS = {
+    "CustomResourceDefinition": 0,
+    "Namespace": 1,
+    "Secret": 2,
+    "ServiceAccount": 2,
+    "PersistentVolume": 2,
+    "PersistentVolumeClaim": 2,
+    "ConfigMap": 2,
+    "Role": 3,
+    "ClusterRole": 3,
+    "RoleBinding": 4,
+    "ClusterRoleBinding": 4,
+}
+DEFAULT_APPLY_TIER = 5
+# Time the deletes of a teardown are waited for, so that the remove hook does not stall
+TEARDOWN_TIMEOUT = 30.0
+
+
+@dataclasses.dataclass
+class ApplyResult:
+    """Result of the apply of a Kubernetes resource by `bulk_apply`.
+
+    Args:
+        resource: the resource that was applied
+        attempts: the number of apply requests made for the resource
+        error: the error of the last request if the apply failed, else None
+    """
+
+    resource: Resource
+    attempts: int = 0
+    error: Optional[ApiError] = None
+
+    @property
+    def name(self) -> str:
+        """Returns the kind and name of the resource, eg: `ClusterRole/kubeflow-volumes`."""
+        return f"{self.resource.kind}/{self.resource.metadata.name}"
+
+
+def bulk_apply(
+    client: Client,
+    resources: List[Resource],
+    force: bool = True,
+    max_workers: int = BULK_APPLY_MAX_WORKERS,
+    attempts: int = BULK_APPLY_ATTEMPTS,
+    backoff: float = BULK_APPLY_BACKOFF,
+) -> List[ApplyResult]:
+    """Server-side applies resources concurrently, tier by tier, returning the result of each.
+
+    Resources are grouped in tiers by kind (eg: ServiceAccounts and ClusterRoles before the
+    ClusterRoleBindings referencing them).  The resources of a tier are applied concurrently, by up
+    to `max_workers` requests at a time, and the next tier is only applied once all the resources
+    of the current tier were applied successfully.  Throttling and server errors are retried up to
+    `attempts` times, with an exponential backoff.
+
+    Args:
+        client: the lightkube Client used to apply the resources
+        resources: the resources to apply
+        force: whether to force the apply over fields owned by other field managers
+        max_workers: the maximum number of concurrent apply requests
+        attempts: the maximum number of apply requests per resource
+        backoff: the delay before the first retry, doubled on every retry
+
+    Returns:
+        The result of each resource, in the order they were applied.  Resources of the tiers
+        following a tier with a failure are not applied, and have no result.
+    """
+
+    def apply(resource: Resource) -> ApplyResult:
+        return _apply_with_retries(client, resource, force, attempts, backoff)
+
+    def tier(resource: Resource) -> int:
+        return APPLY_TIERS.get(resource.kind, DEFAULT_APPLY_TIER)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _, tier_resources in groupby(sorted(resources, key=tier), key=tier):
+            tier_results = list(executor.map(apply, tier_resources))
+            results.extend(tier_results)
+            if any(result.error for result in tier_results):
+                break
+
+    for result in results:
+        if result.error:
+            logger.warning(
+                f"Failed to apply {result.name} after {result.attempts} attempts: {result.error}"
+            )
+        else:
+            logger.debug(f"Applied {result.name} in {result.attempts} attempts")
+    return results
+
+
+def _apply_with_retries(
+    client: Client, resource: Resource, force: bool, attempts: int, backoff: float
+) -> ApplyResult:
+    """Server-side applies a resource, retrying transient errors with an exponential backoff."""
+    result = ApplyResult(resource)
+    namespace = resource.metadata.namespace if isinstance(resource, NamespacedResource) else None
+    while result.attempts < attempts:
+        result.attempts += 1
+        try:
+            client.apply(
+                obj=resource, namespace=namespace, field_manager=FIELD_MANAGER, force=force
+            )
+            result.error = None
+            return result
+        except ApiError as e:
+            result.error = e
+            if not _is_retriable(e) or result.attempts >= attempts:
+                return result
+            delay = backoff * 2 ** (result.attempts - 1)
+            logger.debug(f"Failed to apply {result.name} ({e}), retrying in {delay}s")
+            time.sleep(delay)
+    return result
+
+
+@dataclasses.dataclass(frozen=True)
+class DeleteTarget:
+    """Kubernetes resources to delete with `bulk_delete`, by name, label selector or namespace.
+
+    Args:
+        resource_type: the lightkube resource type of the resources
+        labels: the label selector of the resources
+        name: the name of a single resource to delete, instead of a collection
+        namespace: the namespace of the resources.  If None, the resources of a namespaced type
+                   matching `labels` are deleted in all the namespaces.
+
+    Raises:
+        ValueError: if the target is scoped by none of `name`, `labels` and `namespace`, which
+                    would delete every resource of the type in the cluster.
+    """
+
+    resource_type: Type[Resource]
+    labels: Optional[Dict[str, str]] = None
+    name: Optional[str] = None
+    namespace: Optional[str] = None
+
+    def __post_init__(self):
+        if self.name is None and not self.labels and self.namespace is None:
+            raise ValueError(
+                f"Refusing to delete all the {self.resource_type.__name__} resources of the "
+                "cluster, a name, label selector or namespace is required."
+            )
+
+    def __str__(self) -> str:
+        """Returns a description of the target, eg: `ClusterRole app.kubernetes.io/name=app`."""
+        if self.name is not None:
+            return f"{self.resource_type.__name__}/{self.name}"
+        description = f"{self.resource_type.__name__} {build_selector(self.labels or {})}"
+        if self.namespace is not None:
+            description += f" in {self.namespace}"
+        return " ".join(description.split())
+
+
+def bulk_delete(
+    client: Client, targets: List[DeleteTarget], timeout: float = TEARDOWN_TIMEOUT
+) -> List[DeleteTarget]:
+    """Deletes resources concurrently, target by target, waiting for at most `timeout` seconds.
+
+    Resources selected by labels are listed, then deleted by name.  Targets selected by namespace
+    only are deleted with a single deletecollection request.  The dependents of the deleted
+    resources (eg: the Pods of a PVCViewer) are deleted in the background by the garbage
+    collector.  Resources that do not exist, or whose type is not installed (eg: CRDs), are
+    ignored.
+
+    The deletes run in daemon threads, so that the ones that did not complete by the timeout do
+    not keep the hook running.
+
+    Args:
+        client: the lightkube Client used to delete the resources
+        targets: the resources to delete
+        timeout: the maximum time to wait for the deletes, in seconds
+
+    Returns:
+        The targets whose deletion failed or did not complete in time.
+    """
+    deleted = []
+
+    def delete(target: DeleteTarget):
+        try:
+            _delete(client, target)
+            deleted.append(target)
+        except Exception as e:
+            logger.warning(f"Failed to delete {target}: {e}")
+
+    threads = [threading.Thread(target=delete, args=(target,), daemon=True) for target in targets]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    incomplete = [target for target in targets if target not in deleted]
+    if any(thread.is_alive() for thread in threads):
+        logger.warning(f"Deletes of the teardown did not complete within {timeout}s")
+    logger.info(f"Deleted {len(targets) - len(incomplete)}/{len(targets)} Kubernetes targets")
+    return incomplete
+
+
+def _delete(client: Client, target: DeleteTarget):
+    """Deletes the resources of a target, ignoring resources and resource types not found."""
+    try:
+        if target.name is None and not target.labels:
+            client.deletecollection(
+                target.resource_type, namespace=target.namespace, cascade=CascadeType.BACKGROUND
+            )
+            return
+        names = _get_target_names(client, target)
+    except ApiError as e:
+        if e.status.code != 404:
+            raise
+        return
+
+    for name, namespace in names:
+        try:
+            client.delete(
+                target.resource_type, name, namespace=namespace, cascade=CascadeType.BACKGROUND
+            )
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+
+
+def _get_target_names(client: Client, target: DeleteTarget) -> List[Tuple[str, Optional[str]]]:
+    """Returns the (name, namespace) of the resources of a target selected by name or labels."""
+    if target.name is not None:
+        return [(target.name, target.namespace)]
+
+    # Client.deletecollection does not take a label selector, so the resources are listed
+    namespace = target.namespace
+    if issubclass(target.resource_type, NamespacedResource) and namespace is None:
+        namespace = "*"
+    return [
+        (resource.metadata.name, resource.metadata.namespace)
+        for resource in client.list(
+            target.resource_type, namespace=namespace, labels=target.labels
+        )
+    ]
+
+
+def _resource_key(resource: Resource) -> Tuple[str, str, Optional[str]]:
+    """Returns the (kind, name, namespace) identifying a resource."""
+    namespace = resource.metadata.namespace if isinstance(resource, NamespacedResource) else None
+    return type(resource).__name__, resource.metadata.name, namespace
+
+
+def _is_retriable(error: ApiError) -> bool:
+    """Returns whether an apply that failed with an ApiError should be retried."""
+    return error.status.code in RETRIABLE_STATUS_CODES or error.status.code >= 500
+
+
+class KubeflowVolumesKubernetesComponent(KubernetesComponent):
+    """KubernetesComponent that also removes managed resources that are no longer rendered.
+
+    The set of rendered resources depends on the charm configuration (eg: the RoleBindings of
+    shard mode), so resources that fall out of the rendered manifests are deleted instead of
+    being left behind with the permissions they grant.
+
+    The rendered resources are applied with `bulk_apply`, concurrently and with retries.
+
+    When the application is removed, its resources are deleted by label selector with
+    `bulk_delete`, along with the `teardown_targets` (eg: resources created by the workload).
+
+    With a `template_cache`, the manifests are rendered through it, so that hooks rendering them
+    with an unchanged context neither compile the templates nor parse the rendered YAML.
+    """
+
+    def __init__(
+        self,
+        *args,
+        teardown_targets: Optional[Callable[[], List[DeleteTarget]]] = None,
+        template_cache: Optional[TemplateCache] = None,
+        **kwargs,
+    ):
+        """KubernetesComponent that also removes managed resources that are no longer rendered.
+
+        Args:
+            teardown_targets: (optional) a callable returning the resources to delete along with
+                              the resources of the component when the application is removed
+            template_cache: (optional) the TemplateCache used to render the manifests
+            *args: positional arguments of KubernetesComponent
+            **kwargs: keyword arguments of KubernetesComponent
+        """
+        super().__init__(*args, **kwargs)
+        self._teardown_targets = teardown_targets
+        self._template_cache = template_cache
+
+    def _get_kubernetes_resource_handler(self) -> KubernetesResourceHandler:
+        """Returns a KubernetesResourceHandler for this class, rendering through the cache."""
+        if self._template_cache is None:
+            return super()._get_kubernetes_resource_handler()
+        k8s_resource_handler = CachedKubernetesResourceHandler(
+            field_manager=FIELD_MANAGER,
+            template_files=self._resource_templates,
+            context=self._context_callable(),
+            lightkube_client=self._lightkube_client,
+            labels=self._krh_labels,
+            resource_types=self._krh_resource_types,
+            template_cache=self._template_cache,
+        )
+        load_in_cluster_generic_resources(k8s_resource_handler.lightkube_client)
+        return k8s_resource_handler
+
+    def remove(self, event):
+        """Deletes the resources of the component and the teardown targets, within a timeout.
+
+        The resources are kept when only this unit is removed, since the remaining units of the
+        application still use them.
+        """
+        if self._charm.app.planned_units() > 0:
+            logger.info("Keeping the Kubernetes resources, the application is not being removed")
+            return
+
+        krh = self._get_kubernetes_resource_handler()
+        targets = [
+            DeleteTarget(resource_type, labels=krh.labels)
+            for resource_type in sorted(krh.resource_types, key=lambda type_: type_.__name__)
+        ]
+        if self._teardown_targets is not None:
+            targets.extend(self._teardown_targets())
+        incomplete = bulk_delete(krh.lightkube_client, targets)
+        if incomplete:
+            logger.warning(f"Teardown left {', '.join(map(str, incomplete))} behind")
+
+    def repair(self, drifted: Iterable[Tuple[str, str, Optional[str]]]) -> List[ApplyResult]:
+        """Re-applies the desired state of the resources that drifted, and only of those.
+
+        Args:
+            drifted: the (kind, name, namespace) of the resources that were modified or deleted
+                     outside of the charm
+
+        Returns:
+            The result of the apply of each drifted resource that is still desired.  Drifted
+            resources that are no longer rendered are left to the next reconcile of the component.
+        """
+        drifted = {(kind, name, namespace) for kind, name, namespace in drifted}
+        krh = self._get_kubernetes_resource_handler()
+        resources = [
+            resource for resource in krh.render_manifests() if _resource_key(resource) in drifted
+        ]
+        # the drift was made by another field manager, whose fields the apply takes back
+        return bulk_apply(krh.lightkube_client, resources, force=True)
+
+    def _configure_app_leader(self, event):
+        """Reconcile the Kubernetes resources, deleting the ones that are no longer desired."""
+        try:
+            krh = self._get_kubernetes_resource_handler()
+            desired_resources = krh.render_manifests()
+            unexpected_types = {type(resource) for resource in desired_resources} - set(
+                krh.resource_types
+            )
+            if unexpected_types:
+                names = ", ".join(sorted(type_.__name__ for type_ in unexpected_types))
+                raise ValueError(f"Resource types {names} not in allowed resource types")
+
+            desired_keys = {_resource_key(resource) for resource in desired_resources}
+            resources_to_delete = [
+                resource
+                for resource in krh.get_deployed_resources()
+                if _resource_key(resource) not in desired_keys
+            ]
+            delete_many(krh.lightkube_client, resources_to_delete, logger=logger)
+
+            results = bulk_apply(krh.lightkube_client, desired_resources, force=True)
+        except ApiError as e:
+            raise GenericCharmRuntimeError("Failed to create Kubernetes resources") from e
+
+        errors = [result.error for result in results if result.error]
+        if any(error.status.code == 403 for error in errors):
+            # Forbidden likely means that the charm was not deployed with --trust
+            raise ErrorWithStatus(
+                "Cannot apply required resources. Charm may be missing `--trust`", BlockedStatus
+            )
+        if errors:
+            raise GenericCharmRuntimeError("Failed to create Kubernetes resources") from errors[0]
+        logger.info(f"Applied {len(results)} Kubernetes resources")
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Collection, Dict, List, Optional, Type
+
+from charmed_kubeflow_chisme.components import ComponentGraphItem
+from lightkube.core.exceptions import ApiError
+from lightkube.core.resource import Resource
+from ops import (
+    CharmBase,
+    CharmEvents,
+    EventBase,
+    EventSource,
+    Handle,
+    Object,
+    StoredState,
+    pebble,
+)
+
+from components.charm_reconciler import IncrementalCharmReconciler
+from components.kubernetes_components import FIELD_MANAGER
+from kubernetes_drift_watcher import DRIFTED_RESOURCES_ENV, DriftedResource
+
+logger = logging.getLogger(__name__)
+
+DRIFT_WATCHER_SERVICE = "kubernetes-drift-watcher"
+DRIFT_WATCHER_SCRIPT = "src/kubernetes_drift_watcher.py"
+# Socket of the Pebble running in the charm container of the unit's pod
+CHARM_CONTAINER_PEBBLE_SOCKET = "/charm/container/pebble.socket"
+# Directory of the Juju tools (eg: juju-exec) in the charm container
+JUJU_TOOLS_PATH = "/charm/bin"
+
+
+class KubernetesDriftEvent(EventBase):
+    """Event dispatched by the drift watcher when managed Kubernetes resources drifted.
+
+    Attributes:
+        resources: the (kind, name, namespace) of the resources that were modified or deleted
+                   outside of the charm
+    """
+
+    def __init__(self, handle: Handle, resources: Optional[List[DriftedResource]] = None):
+        super().__init__(handle)
+        if resources is None:
+            resources = json.loads(os.environ.get(DRIFTED_RESOURCES_ENV, "[]"))
+        self.resources = [tuple(resource) for resource in resources]
+
+    def snapshot(self) -> Dict:
+        """Save the drifted resources, which are only in the environment of the dispatch."""
+        return {"resources": [list(resource) for resource in self.resources]}
+
+    def restore(self, snapshot: Dict):
+        """Restore the drifted resources."""
+        self.resources = [tuple(resource) for resource in snapshot["resources"]]
+
+
+class KubernetesDriftCharmEvents(CharmEvents):
+    """Charm events, with the `kubernetes_drift` custom event of the drift watcher."""
+
+    kubernetes_drift = EventSource(KubernetesDriftEvent)
+
+
+class KubernetesDriftWatcher(Object):
+    """Runs the drift watcher of a Kubernetes component, and repairs the resources that drifted.
+
+    The watcher (see `kubernetes_drift_watcher.py`) is a Pebble service of the charm container,
+    watching the resources labelled with `labels`.  When some of them are modified or deleted
+    outside of the charm, it dispatches the `kubernetes_drift` event, on which only the resources
+    that drifted are applied again.  If the repair fails, the component is reconciled.
+
+    The watcher only runs on the leader unit, while `config_option` is enabled.  The charm must
+    define its events with KubernetesDriftCharmEvents.
+    """
+
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        reconciler: IncrementalCharmReconciler,
+        component_item: ComponentGraphItem,
+        labels: Dict[str, str],
+        resource_types: Collection[Type[Resource]],
+        config_option: str = "drift-watcher",
+        socket_path: str = CHARM_CONTAINER_PEBBLE_SOCKET,
+    ):
+        super().__init__(charm, DRIFT_WATCHER_SERVICE)
+        self._charm = charm
+        self._reconciler = reconciler
+        self._component_item = component_item
+        self._labels = labels
+        self._resource_types = resource_types
+        self._config_option = config_option
+        self._socket_path = socket_path
+        # whether the watcher was started by this unit, so that it is only stopped if it was, and
+        # the digest of the layer it was started with, so that it is only replanned on changes
+        self._stored.set_default(started=False, layer_digest=None)
+
+        self.framework.observe(charm.on.start, self._on_start)
+        for event in [
+            charm.on.config_changed,
+            charm.on.leader_elected,
+            charm.on.upgrade_charm,
+            charm.on.update_status,
+        ]:
+            self.framework.observe(event, self._on_manage_service)
+        self.framework.observe(charm.on.remove, self._on_remove)
+        self.framework.observe(charm.on.kubernetes_drift, self._on_kubernetes_drift)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the watcher should run on this unit."""
+        return bool(self._charm.model.config[self._config_option]) and self._charm.unit.is_leader()
+
+    def _on_manage_service(self, _):
+        """Start the watcher if it is enabled, else stop it."""
+        self._manage_service(self.enabled)
+
+    def _on_start(self, _):
+        """Start the watcher with its layer added again, eg: the pod was recreated."""
+        self._stored.layer_digest = None
+        self._manage_service(self.enabled)
+
+    def _on_remove(self, _):
+        """Stop the watcher."""
+        self._manage_service(False)
+
+    def _on_kubernetes_drift(self, event: KubernetesDriftEvent):
+        """Apply the resources that drifted, reconciling the component if that failed."""
+        if not self.enabled:
+            # eg: the unit lost leadership while the watcher was running
+            self._manage_service(False)
+            return
+
+        names = ", ".join(f"{kind}/{name}" for kind, name, _ in event.resources)
+        logger.info(f"Repairing drifted Kubernetes resources: {names}")
+        try:
+            failed = [
+                result.name
+                for result in self._component_item.component.repair(event.resources)
+                if result.error
+            ]
+        except ApiError as e:
+            failed = [str(e)]
+        if failed:
+            logger.warning(
+                f"Failed to repair {', '.join(failed)}, reconciling '{self._component_item.name}'"
+            )
+            self._reconciler.invalidate(self._component_item.name)
+            self._reconciler.reconcile(event)
+
+    def _manage_service(self, enabled: bool):
+        """Add the layer of the watcher to the charm container, and start or stop the service."""
+        if not enabled and not self._stored.started:
+            return
+        layer = self._layer(enabled)
+        digest = hashlib.sha256(json.dumps(layer, sort_keys=True).encode()).hexdigest()
+        if enabled and self._stored.started and digest == self._stored.layer_digest:
+            return
+        client = pebble.Client(socket_path=self._socket_path)
+        try:
+            client.add_layer(DRIFT_WATCHER_SERVICE, layer, combine=True)
+            if enabled:
+                client.replan_services()
+            else:
+                services = client.get_services([DRIFT_WATCHER_SERVICE])
+                if services and services[0].is_running():
+                    client.stop_services([DRIFT_WATCHER_SERVICE])
+        except (pebble.ConnectionError, pebble.APIError, pebble.ChangeError) as e:
+            logger.warning(f"Failed to {'start' if enabled else 'stop'} the drift watcher: {e}")
+            return
+        self._stored.started = enabled
+        self._stored.layer_digest = digest if enabled else None
+
+    def _layer(self, enabled: bool) -> pebble.LayerDict:
+        """Returns the Pebble layer of the watcher."""
+        charm_dir = Path(self._charm.charm_dir).absolute()
+        return {
+            "summary": "Kubernetes drift watcher layer",
+            "services": {
+                DRIFT_WATCHER_SERVICE: {
+                    "override": "replace",
+                    "summary": "Watches the Kubernetes resources of the charm for drift",
+                    "command": f"python3 {charm_dir / DRIFT_WATCHER_SCRIPT}",
+                    "startup": "enabled" if enabled else "disabled",
+                    "environment": {
+                        "DRIFT_WATCHER_KINDS": ",".join(
+                            sorted(
+                                resource_type.__name__ for resource_type in self._resource_types
+                            )
+                        ),
+                        "DRIFT_WATCHER_LABELS": json.dumps(self._labels, sort_keys=True),
+                        "DRIFT_WATCHER_FIELD_MANAGER": FIELD_MANAGER,
+                        "JUJU_UNIT_NAME": self._charm.unit.name,
+                        "JUJU_CHARM_DIR": str(charm_dir),
+                        "PYTHONPATH": f"{charm_dir / 'venv'}:{charm_dir / 'lib'}",
+                        "PATH": f"{JUJU_TOOLS_PATH}:/usr/local/bin:/usr/bin:/bin",
+                    },
+                }
+            },
+        }
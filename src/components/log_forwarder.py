@@ -0,0 +1,131 @@
+import json
+import logging
+from typing import Dict, List, Optional, Union
+
+from charms.loki_k8s.v1.loki_push_api import LogForwarder, _PebbleLogClient
+from ops import BoundEvent, CharmBase, Container, Relation
+from ops.pebble import Layer
+
+logger = logging.getLogger(__name__)
+
+
+class KubeflowVolumesLogForwarder(LogForwarder):
+    """LogForwarder only sending to Pebble the log targets that changed.
+
+    The upstream LogForwarder adds a layer for the disabled target of each departed Loki unit,
+    then a layer with all the active targets, on every update, even when the Pebble plan already
+    holds them.  Here, the desired targets are compared with the plan, and only the ones that
+    differ are sent, in a single layer.
+
+    The forwarded log lines can also carry `extra_labels` (eg: the format of the workload logs),
+    updated on `refresh_event`.
+
+    Args:
+        charm: the charm forwarding the logs of its workloads
+        extra_labels: labels added to the topology labels of the forwarded log lines
+        refresh_event: event, or list of events, on which the log forwarding is updated (eg: on
+                       a change of `extra_labels`)
+        one_per_app: whether the logs are sent once per related Loki application, to the
+                     application-level `endpoint` (eg: an ingress or coordinator URL) it
+                     advertises, instead of to every Loki unit.  Applications that do not
+                     advertise one still get the logs sent to every unit.
+        **kwargs: the other arguments of LogForwarder
+    """
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        *,
+        extra_labels: Optional[Dict[str, str]] = None,
+        refresh_event: Optional[Union[BoundEvent, List[BoundEvent]]] = None,
+        one_per_app: bool = False,
+        **kwargs,
+    ):
+        super().__init__(charm, **kwargs)
+        self._extra_labels = extra_labels or {}
+        self._one_per_app = one_per_app
+
+        if refresh_event is not None:
+            if not isinstance(refresh_event, list):
+                refresh_event = [refresh_event]
+            for event in refresh_event:
+                self.framework.observe(event, self._on_refresh)
+
+    def _on_refresh(self, _):
+        """Update the log forwarding of the containers that can be reached."""
+        if not (loki_endpoints := self._retrieve_endpoints_from_relation()):
+            return
+        for container in self._charm.unit.containers.values():
+            if container.can_connect():
+                self._update_endpoints(container, loki_endpoints)
+
+    def _retrieve_endpoints_from_relation(self) -> dict:
+        """Returns the Loki endpoints of the relations, by name of their log target."""
+        loki_endpoints = {}
+        for relation in self._charm.model.relations[self._relation_name]:
+            endpoints = self._fetch_endpoints(relation)
+            if self._one_per_app:
+                endpoints = self._select_app_endpoint(relation, endpoints)
+            loki_endpoints.update(endpoints)
+        return loki_endpoints
+
+    @staticmethod
+    def _select_app_endpoint(relation: Relation, endpoints: Dict[str, str]) -> Dict[str, str]:
+        """Returns the endpoint of a related Loki application, else the endpoints of its units.
+
+        The log target of an application-level endpoint is named after the application.
+        """
+        app_endpoint = relation.data[relation.app].get("endpoint") if relation.app else None
+        if app_endpoint:
+            try:
+                return {relation.app.name: json.loads(app_endpoint)["url"]}
+            except (json.JSONDecodeError, KeyError, TypeError):
+                logger.warning(f"Invalid application endpoint in relation '{relation.name}'")
+        return endpoints
+
+    def _update_endpoints(self, container: Container, loki_endpoints: dict):
+        """Enable forwarding to the active Loki endpoints, and disable it for the inactive ones."""
+        current_targets = container.get_plan().to_dict().get("log-targets", {})
+        changed_targets = {
+            name: target
+            for name, target in self._get_log_targets(current_targets, loki_endpoints).items()
+            if not _is_target_applied(target, current_targets.get(name))
+        }
+        if not changed_targets:
+            return
+        layer = Layer({"log-targets": changed_targets})  # pyright: ignore
+        container.add_layer(f"{container.name}-log-forwarding", layer, combine=True)
+
+    def _get_log_targets(
+        self, current_targets: Dict[str, Dict], loki_endpoints: Dict[str, str]
+    ) -> Dict[str, Dict]:
+        """Returns the log targets the Pebble plan should hold.
+
+        The targets of the active endpoints are enabled, and the targets of the current plan whose
+        endpoint is no longer active are disabled, unless they already are.
+        """
+        inactive_endpoints = {
+            name: "(removed)"
+            for name, target in current_targets.items()
+            if name not in loki_endpoints and "-all" not in target.get("services", [])
+        }
+        targets = _PebbleLogClient._build_log_targets(
+            loki_endpoints=inactive_endpoints, topology=self.topology, enable=False
+        )
+        targets.update(
+            _PebbleLogClient._build_log_targets(
+                loki_endpoints=loki_endpoints, topology=self.topology, enable=True
+            )
+        )
+        for name in loki_endpoints:
+            targets[name]["labels"].update(self._extra_labels)
+        return targets
+
+
+def _is_target_applied(desired: Dict, current: Optional[Dict]) -> bool:
+    """Returns whether a log target of the Pebble plan already matches the desired one."""
+    if current is None:
+        return False
+    return {key: value for key, value in desired.items() if key != "override"} == {
+        key: value for key, value in current.items() if key != "override" and value is not None
+    }
@@ -1,11 +1,17 @@
 import dataclasses
 import logging
+from typing import Optional
 
 from charmed_kubeflow_chisme.components.pebble_component import PebbleServiceComponent
+from ops import BlockedStatus, StatusBase
 from ops.pebble import Layer
 
 logger = logging.getLogger(__name__)
 
+GUNICORN_CONFIG_DESTINATION_PATH = "/etc/config/gunicorn_config.py"
+# Formats of the access log lines supported by the gunicorn config
+ACCESS_LOG_FORMATS = ("text", "json")
+
 
 @dataclasses.dataclass
 class KubeflowVolumesInputs:
@@ -14,9 +20,33 @@ class KubeflowVolumesInputs:
     APP_SECURE_COOKIES: bool
     BACKEND_MODE: str
     VOLUME_VIEWER_IMAGE: str
+    ACCESS_LOG_ENABLED: bool
+    ACCESS_LOG_SAMPLE_RATE: float
+    ACCESS_LOG_EXCLUDE_PATHS: str
+    ACCESS_LOG_FORMAT: str
+    APP_PREFIX: str
 
 
 class KubeflowVolumesPebbleService(PebbleServiceComponent):
+    def _configure_unit(self, event):
+        """Push the config files and update the layer, unless the inputs are invalid."""
+        if self._get_invalid_inputs_status() is None:
+            super()._configure_unit(event)
+
+    def get_status(self) -> StatusBase:
+        """Returns Blocked if the inputs are invalid, else the status of the Pebble service."""
+        return self._get_invalid_inputs_status() or super().get_status()
+
+    def _get_invalid_inputs_status(self) -> Optional[BlockedStatus]:
+        """Returns a Blocked status describing the invalid inputs, if any, else None."""
+        inputs: KubeflowVolumesInputs = self._inputs_getter()
+        if inputs.ACCESS_LOG_FORMAT not in ACCESS_LOG_FORMATS:
+            return BlockedStatus(
+                f"Invalid access-log-format '{inputs.ACCESS_LOG_FORMAT}', expected one of: "
+                f"{', '.join(ACCESS_LOG_FORMATS)}"
+            )
+        return None
+
     def get_layer(self) -> Layer:
         """Pebble configuration layer for kubeflow-volumes."""
         try:
@@ -30,15 +60,19 @@ class KubeflowVolumesPebbleService(PebbleServiceComponent):
                     self.service_name: {
                         "override": "merge",
                         "summary": "entry point for kubeflow-volumes",
-                        "command": "/bin/bash -c 'gunicorn -w 3 --bind 0.0.0.0:5000 --access-logfile - entrypoint:app'",  # noqa: E501
+                        "command": f"/bin/bash -c 'gunicorn -c {GUNICORN_CONFIG_DESTINATION_PATH} -w 3 --bind 0.0.0.0:5000 entrypoint:app'",  # noqa: E501
                         "startup": "enabled",
                         "environment": {
                             "USERID_HEADER": "kubeflow-userid",
                             "USERID_PREFIX": "",
                             "APP_SECURE_COOKIES": str(inputs.APP_SECURE_COOKIES).lower(),
                             "BACKEND_MODE": inputs.BACKEND_MODE,
-                            "APP_PREFIX": "/volumes",
+                            "APP_PREFIX": inputs.APP_PREFIX,
                             "VOLUME_VIEWER_IMAGE": inputs.VOLUME_VIEWER_IMAGE,
+                            "ACCESS_LOG_ENABLED": str(inputs.ACCESS_LOG_ENABLED).lower(),
+                            "ACCESS_LOG_SAMPLE_RATE": str(inputs.ACCESS_LOG_SAMPLE_RATE),
+                            "ACCESS_LOG_EXCLUDE_PATHS": inputs.ACCESS_LOG_EXCLUDE_PATHS,
+                            "ACCESS_LOG_FORMAT": inputs.ACCESS_LOG_FORMAT,
                         },
                     }
                 }
@@ -0,0 +1,100 @@
+import logging
+from typing import Dict, Optional
+
+import yaml
+from charmed_kubeflow_chisme.components import SdiRelationBroadcasterComponent
+from charmed_kubeflow_chisme.exceptions import ErrorWithStatus
+from ops import BlockedStatus, CharmBase, Relation, WaitingStatus
+from serialized_data_interface import NoCompatibleVersions, NoVersionsListed, utils
+from serialized_data_interface.errors import UnversionedRelation
+from serialized_data_interface.sdi import SerializedDataInterface
+
+logger = logging.getLogger(__name__)
+
+
+def update_relation_data(databag, data: Dict[str, str]):
+    """Writes the fields of a relation databag whose value changed.
+
+    ops runs `relation-set` for every write, even of the value a field already holds, so the
+    fields that already hold their value are not written.
+    """
+    for key, value in data.items():
+        if databag.get(key) != value:
+            databag[key] = value
+
+
+class WriteIfChangedSerializedDataInterface(SerializedDataInterface):
+    """SerializedDataInterface that does not rewrite unchanged versions or data."""
+
+    def send_versions(self, relation: Relation):
+        """Send the sorted list of supported versions to the related app, if it changed.
+
+        If not the leader, does nothing.
+        """
+        if self.unit.is_leader():
+            update_relation_data(
+                relation.data[self.app],
+                {utils.VERSION_KEY: yaml.safe_dump(sorted(self.versions))},
+            )
+
+    def send_data_if_changed(self, data: dict):
+        """Send data to the related apps that do not have it yet."""
+        for relation in self._relations:
+            if self.unwrap(relation).get(self.app) != data:
+                self.wrap(relation, {self.app: data})
+
+
+def get_write_if_changed_interface(
+    charm: CharmBase, relation_name: str
+) -> Optional[WriteIfChangedSerializedDataInterface]:
+    """Returns a WriteIfChangedSerializedDataInterface for an SDI relation.
+
+    This mirrors `serialized_data_interface.get_interface` and the error handling of
+    `charmed_kubeflow_chisme.components.get_sdi_interface`, returning None when nothing is related
+    and raising ErrorWithStatus on the common error cases.
+    """
+    try:
+        with open("metadata.yaml") as f:
+            metadata = yaml.safe_load(f)
+        relations = {**metadata.get("provides", {}), **metadata.get("requires", {})}
+        interface = WriteIfChangedSerializedDataInterface(
+            charm,
+            relation_name,
+            utils.get_schema(relations[relation_name]["schema"]),
+            set(relations[relation_name]["versions"]),
+            charm.meta.relations[relation_name].role.name,
+        )
+        if not interface._relations:
+            return None
+        for relation in charm.model.relations[relation_name]:
+            interface.send_versions(relation)
+        # Preserve behavior of raising version exceptions immediately.
+        interface.get_data()
+    except (NoVersionsListed, UnversionedRelation) as err:
+        raise ErrorWithStatus(str(err), WaitingStatus) from err
+    except NoCompatibleVersions as err:
+        raise ErrorWithStatus(str(err), BlockedStatus) from err
+    except Exception as err:
+        raise ErrorWithStatus(f"Caught unknown error: '{str(err)}'", BlockedStatus) from err
+
+    return interface
+
+
+class KubeflowVolumesSdiRelationBroadcasterComponent(SdiRelationBroadcasterComponent):
+    """SdiRelationBroadcasterComponent that only writes the relation data that changed.
+
+    The versions and data are compared with the ones already sent on each relation, so that
+    reconciling unchanged data makes no `relation-set` calls.
+    """
+
+    def _configure_app_leader(self, event):
+        """Send data to the related applications that do not have it yet if we are the leader."""
+        interface = self.get_interface()
+        if interface is None:
+            return
+
+        interface.send_data_if_changed(self._data_to_send)
+
+    def get_interface(self) -> Optional[WriteIfChangedSerializedDataInterface]:
+        """Returns the WriteIfChangedSerializedDataInterface object for this interface."""
+        return get_write_if_changed_interface(self._charm, self._relation_name)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
+from lightkube import Client
+from lightkube.core import exceptions
+from lightkube.core.exceptions import ApiError
+from lightkube.resources.core_v1 import Service
+from lightkube.types import PatchType
+from ops import StoredState
+
+logger = logging.getLogger(__name__)
+
+
+class CachedKubernetesServicePatch(KubernetesServicePatch):
+    """KubernetesServicePatch skipping the Kubernetes API when the Service is already patched.
+
+    The namespace and the digest of the last patched Service are kept in the charm's state, so
+    that hooks patching an unchanged Service make no request to the Kubernetes API.  The Service
+    is validated against the cluster again, and repaired if it was edited out of band, on start
+    (eg: after the pod was recreated) and upgrade-charm.
+    """
+
+    _stored = StoredState()
+
+    def __init__(self, charm, *args, **kwargs):
+        super().__init__(charm, *args, **kwargs)
+        self._stored.set_default(patched_digest=None)
+        self.framework.observe(charm.on.start, self._on_start)
+
+    def _patch(self, _) -> None:
+        """Patch the Kubernetes service, unless it is the one that was last patched."""
+        digest = self._get_service_digest()
+        if digest == self._stored.patched_digest:
+            logger.debug(f"Kubernetes service '{self.service_name}' is already patched")
+            return
+
+        try:
+            client = Client()  # pyright: ignore
+        except exceptions.ConfigError as e:
+            logger.warning(f"Error creating k8s client: {e}")
+            return
+
+        try:
+            if not self._is_patched(client):
+                if self.service_name != self._app:
+                    if not self.service_type == "LoadBalancer":
+                        self._delete_and_create_service(client)
+                    else:
+                        self._create_lb_service(client)
+                client.patch(Service, self.service_name, self.service, patch_type=PatchType.MERGE)
+                logger.info(f"Kubernetes service '{self._app}' patched successfully")
+        except ApiError as e:
+            if e.status.code == 403:
+                logger.error("Kubernetes service patch failed: `juju trust` this application.")
+            else:
+                logger.error(f"Kubernetes service patch failed: {e}")
+            return
+        self._stored.patched_digest = digest
+
+    def _on_start(self, event) -> None:
+        """Validate the service against the cluster again, which may have changed while stopped."""
+        self._stored.patched_digest = None
+        self._patch(event)
+
+    def _on_upgrade_charm(self, event) -> None:
+        """Validate the service against the cluster again, with the upgraded charm code."""
+        self._stored.patched_digest = None
+        super()._on_upgrade_charm(event)
+
+    def is_patched(self) -> bool:
+        """Reports if the service patch has been applied, from the charm's state if possible."""
+        if self._get_service_digest() == self._stored.patched_digest:
+            return True
+        return super().is_patched()
+
+    @property
+    def _namespace(self) -> str:
+        """The Kubernetes namespace of the charm, read once and then kept in the charm's state."""
+        # read by KubernetesServicePatch.__init__, before the defaults of this class are set
+        self._stored.set_default(namespace=None)
+        namespace: Optional[str] = self._stored.namespace
+        if namespace is None:
+            namespace = self._stored.namespace = super()._namespace
+        return namespace
+
+    def _get_service_digest(self) -> str:
+        """Returns a digest of the desired service: its name, type, ports, labels and selector."""
+        service = json.dumps(self.service.to_dict(), sort_keys=True)
+        return hashlib.sha256(service.encode()).hexdigest()
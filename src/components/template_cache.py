@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import jinja2
+from charmed_kubeflow_chisme.components import ContainerFileTemplate
+from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler
+from lightkube import codecs
+from lightkube.core.exceptions import LoadResourceError
+from lightkube.core.resource import Resource
+
+logger = logging.getLogger(__name__)
+
+# Number of rendered templates and manifests kept, so that the cache does not grow with every
+# configuration the charm ever had
+MAX_CACHED_RENDERS = 16
+
+
+class TemplateCache:
+    """Caches the compiled Jinja templates and the rendered manifests of the charm on disk.
+
+    Templates only change with a charm upgrade, so hooks rendering them with a context they were
+    already rendered with read the output from the cache instead:
+    * templates are compiled through a Jinja FileSystemBytecodeCache, whose entries are validated
+      against the hash of the template source
+    * rendered templates, and the resources parsed from rendered manifests, are cached by the hash
+      of the template sources and of the context
+
+    Args:
+        directory: the directory of the cache, in the charm's state
+    """
+
+    def __init__(self, directory: Union[Path, str]):
+        self._directory = Path(directory)
+        self._environment: Optional[jinja2.Environment] = None
+
+    @property
+    def environment(self) -> jinja2.Environment:
+        """The Jinja environment loading templates by path, through the bytecode cache."""
+        if self._environment is None:
+            bytecode_directory = self._directory / "bytecode"
+            bytecode_directory.mkdir(parents=True, exist_ok=True)
+            self._environment = jinja2.Environment(
+                loader=jinja2.FunctionLoader(lambda path: Path(path).read_text()),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(str(bytecode_directory)),
+            )
+        return self._environment
+
+    def render(self, template_file: Union[Path, str], context: dict) -> str:
+        """Renders a template file with a context, returning the cached output if available."""
+        path = self._entry("rendered", [template_file], context, ".txt")
+        try:
+            return path.read_text()
+        except OSError:
+            pass
+
+        rendered = self.environment.get_template(str(template_file)).render(**context)
+        self._write(path, rendered)
+        return rendered
+
+    def render_manifests(
+        self,
+        template_files: Iterable[Union[Path, str]],
+        context: dict,
+        create_resources_for_crds: bool = True,
+    ) -> List[Resource]:
+        """Renders manifest templates with a context, returning the resources they define.
+
+        Resources are read from the cache if the templates were already rendered with the context,
+        skipping both the rendering and the YAML parsing of the manifests.
+        """
+        template_files = list(template_files)
+        path = self._entry("manifests", template_files, context, ".json")
+        try:
+            return [codecs.from_dict(resource) for resource in json.loads(path.read_text())]
+        except (OSError, ValueError, LoadResourceError):
+            pass
+
+        manifests = "\n---\n".join(
+            self.render(template_file, context) for template_file in template_files
+        )
+        resources = codecs.load_all_yaml(
+            manifests, create_resources_for_crds=create_resources_for_crds
+        )
+        self._write(path, json.dumps([resource.to_dict() for resource in resources]))
+        return resources
+
+    def _entry(
+        self, kind: str, template_files: List[Union[Path, str]], context: dict, suffix: str
+    ) -> Path:
+        """Returns the path of the cache entry of templates rendered with a context."""
+        key = hashlib.sha256()
+        for template_file in template_files:
+            key.update(hashlib.sha256(Path(template_file).read_bytes()).digest())
+        key.update(json.dumps(context, sort_keys=True, default=str).encode())
+        return self._directory / kind / f"{key.hexdigest()}{suffix}"
+
+    def _write(self, path: Path, content: str):
+        """Writes a cache entry atomically, pruning the least recently written entries."""
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = path.with_name(f".{path.name}.{os.getpid()}")
+            temporary_path.write_text(content)
+            temporary_path.replace(path)
+            entries = sorted(path.parent.iterdir(), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:-MAX_CACHED_RENDERS]:
+                entry.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to write the template cache entry {path}: {e}")
+
+
+class CachedKubernetesResourceHandler(KubernetesResourceHandler):
+    """KubernetesResourceHandler rendering its manifests through a TemplateCache."""
+
+    def __init__(self, *args, template_cache: TemplateCache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._template_cache = template_cache
+
+    def render_manifests(
+        self,
+        template_files: Optional[Iterable[str]] = None,
+        context: Optional[dict] = None,
+        force_recompute: bool = False,
+        create_resources_for_crds: bool = True,
+    ) -> List[Resource]:
+        """Renders this charm's manifests, returning them as a list of Lightkube Resources.
+
+        See KubernetesResourceHandler.render_manifests, of which this is a cached version.
+        """
+        if template_files is not None:
+            self.template_files = template_files
+        if context is not None:
+            self.context = context
+        if self._manifests is not None and not force_recompute:
+            return self._manifests
+
+        for attr in ["context", "template_files"]:
+            if getattr(self, attr) is None:
+                raise ValueError(f"render_manifests requires {attr} be defined")
+
+        self._manifests = self._template_cache.render_manifests(
+            self.template_files, self.context, create_resources_for_crds
+        )
+        if self._labels is not None:
+            self._manifests = [_add_labels(resource, self._labels) for resource in self._manifests]
+        return self._manifests
+
+
+def _add_labels(resource: Resource, labels: dict) -> Resource:
+    """Returns the resource with the labels added to its metadata."""
+    if resource.metadata.labels is None:
+        resource.metadata.labels = {}
+    if resource.metadata.labels is None:
+        # the metadata of some resources cannot be assigned labels, so they are set through a dict
+        as_dict = resource.to_dict()
+        as_dict["metadata"]["labels"] = {}
+        resource = resource.from_dict(as_dict)
+    resource.metadata.labels.update(labels)
+    return resource
+
+
+class CachedContainerFileTemplate(ContainerFileTemplate):
+    """ContainerFileTemplate rendering its source template through a TemplateCache."""
+
+    def __init__(self, *args, template_cache: TemplateCache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._template_cache = template_cache
+
+    def render_source_template(self) -> str:
+        """Renders the source template with the given context, returning as a string."""
+        if self._source_template_path is None:
+            return super().render_source_template()
+        return self._template_cache.render(self.source_template_path, self.context)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Watches the Kubernetes resources managed by the charm, and reports the ones that drifted.
+
+Runs as a Pebble service of the charm container, started by `KubernetesDriftWatcher`.  Resources
+matching the label selector are watched in all the namespaces, one watch per resource kind, and
+the ones that were modified or deleted by someone else than the charm are reported to the charm
+by dispatching the `kubernetes_drift` Juju custom event with `juju-exec`.
+
+Configured with the following environment variables:
+* DRIFT_WATCHER_KINDS: comma-separated resource kinds to watch (eg: `ClusterRole,ServiceAccount`)
+* DRIFT_WATCHER_LABELS: label selector of the resources to watch, as a JSON object
+* DRIFT_WATCHER_FIELD_MANAGER: field manager of the charm's applies, whose changes are not drift
+* JUJU_UNIT_NAME and JUJU_CHARM_DIR: unit the event is dispatched to, and its charm directory
+"""
+
+import json
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from lightkube import Client
+from lightkube.core.resource import NamespacedResource, Resource
+from lightkube.resources.core_v1 import ServiceAccount
+from lightkube.resources.rbac_authorization_v1 import (
+    ClusterRole,
+    ClusterRoleBinding,
+    RoleBinding,
+)
+
+logger = logging.getLogger(__name__)
+
+DRIFT_EVENT_NAME = "kubernetes_drift"
+# Environment variable of the dispatched event holding the drifted resources
+DRIFTED_RESOURCES_ENV = "DRIFTED_RESOURCES"
+RESOURCE_TYPES = {
+    resource.__name__: resource
+    for resource in (ServiceAccount, ClusterRole, ClusterRoleBinding, RoleBinding)
+}
+# Time during which drift is collected before it is reported, so that a burst of changes (eg: a
+# `kubectl delete -l ...`) is repaired by a single event
+DEBOUNCE_SECONDS = 2.0
+RETRY_SECONDS = 5.0
+
+# A drifted resource, as (kind, name, namespace)
+DriftedResource = Tuple[str, str, Optional[str]]
+
+
+def drifted_resource(
+    event_type: str, obj: Resource, field_manager: str
+) -> Optional[DriftedResource]:
+    """Returns the resource of a watch event if it drifted, else None.
+
+    Added resources are not drift (the watch starts by listing the existing resources as added),
+    and neither are the modifications whose latest field manager is the charm's.
+    """
+    if event_type not in ("MODIFIED", "DELETED"):
+        return None
+    if event_type == "MODIFIED":
+        latest = max(
+            obj.metadata.managedFields or [],
+            key=lambda entry: entry.time.timestamp() if entry.time else 0,
+            default=None,
+        )
+        if latest is not None and latest.manager == field_manager:
+            return None
+    return _resource_key(obj)
+
+
+class ResourceWatcher:
+    """Watches the resources of a kind, putting the ones that drifted on a queue.
+
+    The resources are listed before the watch starts, and listed again whenever the watch cannot
+    be resumed from the last resourceVersion it saw, so that the resources modified or deleted
+    while the watch was down are reported too.
+
+    Args:
+        client: the lightkube Client used to list and watch the resources
+        resource_type: the lightkube resource type of the resources
+        labels: the label selector of the resources
+        field_manager: the field manager of the charm's applies, whose changes are not drift
+        drifted: the queue the drifted resources are put on
+    """
+
+    def __init__(
+        self, client: Client, resource_type, labels: dict, field_manager: str, drifted: queue.Queue
+    ):
+        self._client = client
+        self._resource_type = resource_type
+        self._labels = labels
+        self._field_manager = field_manager
+        self._drifted = drifted
+        # resources of a namespaced kind are watched in all the namespaces (eg: RoleBindings)
+        self._namespace = "*" if issubclass(resource_type, NamespacedResource) else None
+        # resourceVersion of each resource last seen, and of the last event of the watch
+        self._known: Dict[DriftedResource, str] = {}
+        self.resource_version: Optional[str] = None
+
+    def run(self):
+        """Watches the resources forever, restarting the watch when it fails."""
+        failed_version = None
+        while True:
+            try:
+                self.watch()
+            except Exception as e:
+                logger.warning(f"Watch of {self._resource_type.__name__} failed ({e}), restarting")
+                if self.resource_version == failed_version:
+                    # no event since the last failure (eg: the version expired), list again
+                    self.resource_version = None
+                failed_version = self.resource_version
+                time.sleep(RETRY_SECONDS)
+
+    def watch(self):
+        """Watches the resources, from the last resourceVersion seen or after listing them."""
+        if self.resource_version is None:
+            self.resync()
+        for event_type, obj in self._client.watch(
+            self._resource_type,
+            namespace=self._namespace,
+            labels=self._labels,
+            resource_version=self.resource_version,
+        ):
+            self.resource_version = obj.metadata.resourceVersion
+            self._observe(event_type, obj)
+
+    def resync(self):
+        """Lists the resources, reporting the ones that drifted since they were last seen."""
+        listed = {
+            _resource_key(obj): obj
+            for obj in self._client.list(
+                self._resource_type, namespace=self._namespace, labels=self._labels
+            )
+        }
+        for resource in sorted(set(self._known) - set(listed), key=str):
+            self._report("DELETED", resource)
+        for key, obj in listed.items():
+            if key in self._known and self._known[key] != obj.metadata.resourceVersion:
+                self._report("MODIFIED", drifted_resource("MODIFIED", obj, self._field_manager))
+        self._known = {key: obj.metadata.resourceVersion for key, obj in listed.items()}
+
+    def _observe(self, event_type: str, obj: Resource):
+        """Records a watch event, reporting the resource if it drifted."""
+        key = _resource_key(obj)
+        previous_version = self._known.pop(key, None)
+        if event_type != "DELETED":
+            self._known[key] = obj.metadata.resourceVersion
+        if event_type == "ADDED" and previous_version not in (None, obj.metadata.resourceVersion):
+            # a watch started without a resourceVersion replays the existing resources as added,
+            # including the ones modified since they were listed
+            event_type = "MODIFIED"
+        self._report(event_type, drifted_resource(event_type, obj, self._field_manager))
+
+    def _report(self, event_type: str, resource: Optional[DriftedResource]):
+        """Puts a drifted resource on the queue, if the resource drifted."""
+        if resource is not None:
+            logger.info(f"{event_type} {resource[0]} {resource[1]} drifted")
+            self._drifted.put(resource)
+
+
+def _resource_key(obj: Resource) -> DriftedResource:
+    """Returns the (kind, name, namespace) of a resource."""
+    return type(obj).__name__, obj.metadata.name, obj.metadata.namespace
+
+
+def collect(drifted: queue.Queue, debounce: float = DEBOUNCE_SECONDS) -> List[DriftedResource]:
+    """Waits for drift, returning the distinct resources that drifted within `debounce` seconds."""
+    resources = [drifted.get()]
+    deadline = time.monotonic() + debounce
+    while (timeout := deadline - time.monotonic()) > 0:
+        try:
+            resources.append(drifted.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return sorted(set(resources), key=lambda resource: tuple(map(str, resource)))
+
+
+def dispatch(unit_name: str, charm_dir: str, resources: Iterable[DriftedResource]):
+    """Dispatches the kubernetes_drift custom event of the charm, for the drifted resources."""
+    command = (
+        f"{DRIFTED_RESOURCES_ENV}={shlex.quote(json.dumps(list(resources)))} "
+        f"JUJU_DISPATCH_PATH=hooks/{DRIFT_EVENT_NAME} {charm_dir}/dispatch"
+    )
+    subprocess.run(["juju-exec", unit_name, command], check=False)
+
+
+def main():
+    """Watches the resources until the process is stopped."""
+    logging.basicConfig(level=logging.INFO)
+    labels = json.loads(os.environ["DRIFT_WATCHER_LABELS"])
+    field_manager = os.environ["DRIFT_WATCHER_FIELD_MANAGER"]
+    client = Client(field_manager=field_manager)
+    drifted: queue.Queue = queue.Queue()
+
+    for kind in os.environ["DRIFT_WATCHER_KINDS"].split(","):
+        watcher = ResourceWatcher(client, RESOURCE_TYPES[kind], labels, field_manager, drifted)
+        threading.Thread(target=watcher.run, daemon=True).start()
+
+    while True:
+        resources = collect(drifted)
+        logger.info(f"Reporting {len(resources)} drifted resources")
+        dispatch(os.environ["JUJU_UNIT_NAME"], os.environ["JUJU_CHARM_DIR"], resources)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Gunicorn configuration for kubeflow-volumes, pushed into the workload container by the charm.
+
+Access logging is controlled with the following environment variables of the Pebble service:
+* ACCESS_LOG_ENABLED: "false" disables the access log entirely
+* ACCESS_LOG_SAMPLE_RATE: fraction (0.0 to 1.0) of the successful requests that are logged
+* ACCESS_LOG_EXCLUDE_PATHS: comma-separated path prefixes whose successful requests are not logged
+* ACCESS_LOG_FORMAT: "json" writes each access log line as a JSON object with the method, path,
+  status, response bytes, duration in microseconds and user (`kubeflow-userid` header) of the
+  request, instead of gunicorn's default text format
+
+Requests that failed (status >= 400) are always logged, and the error log is never filtered.
+"""
+
+import json
+import os
+import random
+
+from gunicorn.glogging import Logger
+
+accesslog = "-" if os.environ.get("ACCESS_LOG_ENABLED", "true") == "true" else None
+
+
+class FilteredAccessLogger(Logger):
+    """Gunicorn Logger that samples the access log and drops excluded paths."""
+
+    sample_rate = min(max(float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "1.0")), 0.0), 1.0)
+    exclude_paths = tuple(
+        path.strip()
+        for path in os.environ.get("ACCESS_LOG_EXCLUDE_PATHS", "").split(",")
+        if path.strip()
+    )
+    json_format = os.environ.get("ACCESS_LOG_FORMAT", "text") == "json"
+
+    def access(self, resp, req, environ, request_time):
+        """Write the access log line of a request, unless it is filtered out."""
+        if not self.should_log(resp, req):
+            return
+        if not self.json_format:
+            super().access(resp, req, environ, request_time)
+        elif self.cfg.accesslog:
+            self.access_log.info(json.dumps(self.json_fields(resp, req, environ, request_time)))
+
+    def json_fields(self, resp, req, environ, request_time) -> dict:
+        """Returns the fields of the JSON access log line of a request."""
+        return {
+            "method": req.method,
+            "path": req.path,
+            "status": _status_code(resp),
+            "bytes": getattr(resp, "sent", 0) or 0,
+            "duration_us": request_time.days * 86400000000
+            + request_time.seconds * 1000000
+            + request_time.microseconds,
+            "user": environ.get("HTTP_KUBEFLOW_USERID", ""),
+        }
+
+    def should_log(self, resp, req) -> bool:
+        """Returns whether the access log line of a request should be written."""
+        if _status_code(resp) >= 400:
+            return True
+        if self.exclude_paths and req.path.startswith(self.exclude_paths):
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+
+def _status_code(resp) -> int:
+    """Returns the status code of a gunicorn Response."""
+    status_code = getattr(resp, "status_code", None)
+    if status_code is None:
+        status_code = int(str(resp.status).split()[0])
+    return status_code
+
+
+logger_class = FilteredAccessLogger
@@ -0,0 +1,234 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the IncrementalCharmReconciler."""
+
+import threading
+from unittest.mock import MagicMock
+
+from charmed_kubeflow_chisme.components import Component
+from ops import ActiveStatus, BlockedStatus, CharmBase, StatusBase
+from ops.testing import Harness
+
+from components.charm_reconciler import ComponentInputs, IncrementalCharmReconciler
+
+
+class FakeClient:
+    """Fake API client recording its calls, and how many of them were in flight at once."""
+
+    def __init__(self):
+        self.calls = []
+        self.threads = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def apply(self, name: str):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.threads.add(threading.current_thread())
+        self.calls.append(name)
+        with self._lock:
+            self.in_flight -= 1
+
+
+class FakeComponent(Component):
+    """Component that applies itself with a FakeClient."""
+
+    def __init__(self, *args, client: FakeClient, status: StatusBase = ActiveStatus(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = client
+        self._status = status
+
+    def _configure_app_leader(self, event):
+        self._client.apply(self.name)
+
+    def get_status(self) -> StatusBase:
+        return self._status
+
+
+class ReconcilerCharm(CharmBase):
+    """Charm with a gate, two independent components depending on it, and a last component."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.client = FakeClient()
+        self.reconciler = IncrementalCharmReconciler(self)
+        gate = self.reconciler.add(
+            FakeComponent(self, name="gate", client=self.client), depends_on=[]
+        )
+        first = self.reconciler.add(
+            FakeComponent(self, name="first", client=self.client), depends_on=[gate]
+        )
+        second = self.reconciler.add(
+            FakeComponent(self, name="second", client=self.client), depends_on=[gate]
+        )
+        self.reconciler.add(
+            FakeComponent(self, name="last", client=self.client), depends_on=[first, second]
+        )
+        self.reconciler.install_default_event_handlers()
+
+
+def test_execution_order_and_thread():
+    """Test that components run one at a time on the main thread, after their dependencies.
+
+    The ops model the components read and write is not thread-safe.
+    """
+    harness = Harness(ReconcilerCharm, meta="name: test")
+    harness.set_leader(True)
+    harness.begin()
+
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.client.calls == ["gate", "first", "second", "last"]
+    assert harness.charm.client.max_in_flight == 1
+    assert harness.charm.client.threads == {threading.main_thread()}
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+
+def test_execution_status():
+    """Test that the unit status is the first worst status in the order components were added."""
+    harness = Harness(ReconcilerCharm, meta="name: test")
+    harness.set_leader(True)
+    harness.begin()
+    items = harness.charm.reconciler._component_graph.component_items
+    items["first"].component._status = BlockedStatus("first failed")
+    items["second"].component._status = BlockedStatus("second failed")
+
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.unit.status == BlockedStatus("[first] first failed")
+    assert "last" not in harness.charm.client.calls
+
+
+class FastUpdateStatusCharm(CharmBase):
+    """Charm with a component running a Pebble service, and a fast update-status."""
+
+    full_reconcile_interval = 100
+    # runtime state read by the component, outside of the model
+    state = {"namespaces": []}
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.client = FakeClient()
+        self.reconciler = IncrementalCharmReconciler(
+            self, fast_update_status=True, full_reconcile_interval=self.full_reconcile_interval
+        )
+        self.reconciler.add(
+            FakeComponent(self, name="workload", client=self.client),
+            depends_on=[],
+            inputs=ComponentInputs(
+                config=["port"], containers=["workload"], state=self._get_state
+            ),
+        )
+        self.reconciler.install_default_event_handlers()
+
+    def _get_state(self) -> dict:
+        if self.state is None:
+            raise ConnectionError("apiserver unavailable")
+        return self.state
+
+
+def fast_update_status_harness(full_reconcile_interval: int = 100) -> Harness:
+    """Returns a Harness of FastUpdateStatusCharm, whose workload service is running."""
+    charm_type = type(
+        "Charm", (FastUpdateStatusCharm,), {"full_reconcile_interval": full_reconcile_interval}
+    )
+    harness = Harness(
+        charm_type,
+        meta="name: test\ncontainers:\n  workload: {}\n",
+        config="options:\n  port:\n    type: int\n    default: 5000\n",
+    )
+    harness.set_leader(True)
+    harness.set_can_connect("workload", True)
+    harness.begin()
+    container = harness.charm.unit.get_container("workload")
+    container.add_layer(
+        "workload",
+        {
+            "services": {
+                "workload": {"override": "replace", "command": "run", "startup": "enabled"}
+            }
+        },
+    )
+    container.replan()
+    return harness
+
+
+def test_fast_update_status():
+    """Test that update-status only executes components when their inputs or health drifted."""
+    harness = fast_update_status_harness()
+    container = harness.charm.unit.get_container("workload")
+
+    def executions() -> int:
+        executions = len(harness.charm.client.calls)
+        harness.charm.client.calls.clear()
+        return executions
+
+    harness.charm.on.config_changed.emit()
+    assert executions() == 1
+
+    # nothing drifted
+    harness.charm.on.update_status.emit()
+    assert executions() == 0
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+    # the service stopped
+    container.stop("workload")
+    harness.charm.on.update_status.emit()
+    assert executions() == 1
+    container.start("workload")
+
+    # the inputs changed without the component being executed
+    with harness.hooks_disabled():
+        harness.update_config({"port": 5001})
+    harness.charm.on.update_status.emit()
+    assert executions() == 1
+
+    # the unit is not Active: its status is recomputed, but the component did not drift
+    harness.charm.unit.status = BlockedStatus("blocked")
+    harness.charm.on.update_status.emit()
+    assert executions() == 0
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+    # the runtime state changed
+    harness.charm.state = {"namespaces": ["team-a"]}
+    harness.charm.on.update_status.emit()
+    assert executions() == 1
+
+    # the runtime state is unavailable
+    harness.charm.state = None
+    harness.charm.on.update_status.emit()
+    assert executions() == 1
+
+
+def test_fast_update_status_full_reconcile():
+    """Test that every full_reconcile_interval update-status executes all the components."""
+    harness = fast_update_status_harness(full_reconcile_interval=5)
+    harness.charm.on.config_changed.emit()
+    harness.charm.client.calls.clear()
+
+    # nothing drifted, but the 5th and 10th update-status execute everything anyway
+    for _ in range(10):
+        harness.charm.on.update_status.emit()
+    assert harness.charm.client.calls == ["workload", "workload"]
+
+
+def test_runtime_state_is_read_once_on_update_status():
+    """Test that the runtime state is read once per update-status, and reused by other events."""
+    harness = fast_update_status_harness()
+    harness.charm._get_state = get_state = MagicMock(return_value={"namespaces": []})
+    harness.charm.reconciler._inputs["workload"] = ComponentInputs(
+        config=["port"], containers=["workload"], state=get_state
+    )
+
+    harness.charm.on.config_changed.emit()
+    harness.charm.on.config_changed.emit()
+    assert get_state.call_count == 1
+
+    # the state changed: update-status reads it once for the drift check and the execution
+    get_state.reset_mock()
+    get_state.return_value = {"namespaces": ["team-a"]}
+    harness.charm.on.update_status.emit()
+    assert get_state.call_count == 1
+    assert harness.charm.client.calls[-1] == "workload"
@@ -0,0 +1,101 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the gunicorn configuration pushed into the workload container."""
+
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from gunicorn.config import Config
+
+from components.template_cache import TemplateCache
+
+GUNICORN_CONFIG = "src/templates/gunicorn_config.py"
+
+
+@pytest.fixture()
+def access_logger(tmp_path, monkeypatch):
+    """Returns a function creating the access logger of the rendered config, for environment."""
+
+    def create(**environment):
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        config = {}
+        exec(TemplateCache(tmp_path).render(GUNICORN_CONFIG, {}), config)
+        cfg = Config()
+        cfg.set("accesslog", config["accesslog"])
+        logger = config["logger_class"](cfg)
+        logger.access_log = MagicMock()
+        return logger
+
+    return create
+
+
+def log(logger, path: str = "/volumes/api/pvcs", status: str = "200 OK") -> list:
+    """Drives the access log of a request, returning the lines written."""
+    logger.access_log.reset_mock()
+    request = SimpleNamespace(
+        method="GET", path=path, query="", uri=path, version=(1, 1), headers=[]
+    )
+    response = SimpleNamespace(status=status, sent=42, response_length=42, headers=[])
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "RAW_URI": path,
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "10.0.0.1",
+        "HTTP_KUBEFLOW_USERID": "user@example.com",
+    }
+    logger.access(response, request, environ, timedelta(seconds=1, microseconds=2500))
+    return [args for args, _ in logger.access_log.info.call_args_list]
+
+
+def test_access_log_text_format(access_logger):
+    """Test that requests are logged in gunicorn's text format by default."""
+    ((access_log_format, atoms),) = log(access_logger())
+    assert access_log_format == Config().access_log_format
+    assert (atoms["m"], atoms["U"], atoms["s"]) == ("GET", "/volumes/api/pvcs", "200")
+
+
+def test_access_log_json_format(access_logger):
+    """Test the fields of the JSON access log lines, with their duration in microseconds."""
+    ((line,),) = log(access_logger(ACCESS_LOG_FORMAT="json"))
+    assert json.loads(line) == {
+        "method": "GET",
+        "path": "/volumes/api/pvcs",
+        "status": 200,
+        "bytes": 42,
+        "duration_us": 1002500,
+        "user": "user@example.com",
+    }
+
+
+def test_access_log_disabled(access_logger):
+    """Test that a disabled access log writes nothing, in either format."""
+    assert log(access_logger(ACCESS_LOG_ENABLED="false")) == []
+    assert log(access_logger(ACCESS_LOG_ENABLED="false", ACCESS_LOG_FORMAT="json")) == []
+
+
+def test_access_log_sample_rate(access_logger, monkeypatch):
+    """Test that a fraction of the successful requests is logged, and all the failed ones."""
+    logger = access_logger(ACCESS_LOG_SAMPLE_RATE="0.25")
+    monkeypatch.setattr("random.random", lambda: 0.2)
+    assert len(log(logger)) == 1
+    monkeypatch.setattr("random.random", lambda: 0.3)
+    assert log(logger) == []
+    assert len(log(logger, status="500 Internal Server Error")) == 1
+
+    assert log(access_logger(ACCESS_LOG_SAMPLE_RATE="-1")) == []
+    assert len(log(access_logger(ACCESS_LOG_SAMPLE_RATE="2"))) == 1
+
+
+def test_access_log_exclude_paths(access_logger):
+    """Test that the successful requests of excluded path prefixes are not logged."""
+    logger = access_logger(ACCESS_LOG_EXCLUDE_PATHS=" /healthz, /volumes/static ,")
+    assert log(logger, path="/healthz") == []
+    assert log(logger, path="/volumes/static/main.js") == []
+    assert len(log(logger, path="/volumes/static/main.js", status="404 Not Found")) == 1
+    assert len(log(logger, path="/volumes/api/pvcs")) == 1
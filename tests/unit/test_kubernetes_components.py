@@ -0,0 +1,245 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the Kubernetes components."""
+
+import threading
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+from charmed_kubeflow_chisme.exceptions import ErrorWithStatus, GenericCharmRuntimeError
+from jinja2 import Template
+from lightkube import codecs
+from lightkube.core.exceptions import ApiError
+from lightkube.models.meta_v1 import ObjectMeta
+from lightkube.resources.core_v1 import Service
+from lightkube.resources.rbac_authorization_v1 import ClusterRole, RoleBinding
+from ops import BlockedStatus
+
+from components.kubernetes_components import (
+    DeleteTarget,
+    KubeflowVolumesKubernetesComponent,
+    bulk_apply,
+    bulk_delete,
+)
+
+LATENCY = 0.05
+
+
+def api_error(code: int) -> ApiError:
+    """Returns an ApiError with the given status code."""
+    response = httpx.Response(status_code=code, json={"code": code, "message": f"error {code}"})
+    return ApiError(response=response)
+
+
+class FakeClient:
+    """Fake lightkube Client whose applies take LATENCY seconds and can fail.
+
+    The applies of the kinds in `barriers` wait for `parties` applies of the kind to be in flight.
+    """
+
+    def __init__(self, errors: dict = None, barriers: dict = None):
+        self.applied = []
+        self.errors = errors or {}
+        self.forced = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._barriers = {
+            kind: threading.Barrier(parties, timeout=5)
+            for kind, parties in (barriers or {}).items()
+        }
+        self._lock = threading.Lock()
+
+    def apply(self, obj, namespace=None, field_manager=None, force=False):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.monotonic()
+        if obj.kind in self._barriers:
+            self._barriers[obj.kind].wait()
+        time.sleep(LATENCY)
+        with self._lock:
+            self.in_flight -= 1
+            self.applied.append((f"{obj.kind}/{obj.metadata.name}", start, time.monotonic()))
+            self.forced.add(force)
+            errors = self.errors.get(f"{obj.kind}/{obj.metadata.name}")
+            if errors:
+                raise errors.pop(0)
+        return obj
+
+
+@pytest.fixture()
+def auth_resources():
+    """Returns the resources of the auth manifests."""
+    template = Template(Path("src/templates/auth_manifests.yaml.j2").read_text())
+    return codecs.load_all_yaml(
+        template.render(app_name="volumes", namespace="kubeflow", shard_mode=False)
+    )
+
+
+def test_bulk_apply_orders_tiers(auth_resources):
+    """Test that bindings are only applied once the ServiceAccount and roles were applied."""
+    client = FakeClient()
+
+    results = bulk_apply(client, auth_resources)
+
+    assert [result.error for result in results] == [None] * len(auth_resources)
+    first_binding_start = min(
+        start for name, start, _ in client.applied if name.startswith("ClusterRoleBinding/")
+    )
+    last_dependency_end = max(
+        end for name, _, end in client.applied if not name.startswith("ClusterRoleBinding/")
+    )
+    assert first_binding_start >= last_dependency_end
+
+
+def test_bulk_apply_is_concurrent(auth_resources):
+    """Test that the resources of a tier are applied concurrently, by up to max_workers."""
+    cluster_roles = sum(resource.kind == "ClusterRole" for resource in auth_resources)
+    # the ClusterRoles only get past the barrier if they are all applied at the same time
+    client = FakeClient(barriers={"ClusterRole": cluster_roles})
+    results = bulk_apply(client, auth_resources, max_workers=cluster_roles)
+    assert [result.error for result in results] == [None] * len(auth_resources)
+    assert client.max_in_flight == cluster_roles
+    assert client.forced == {True}
+
+    client = FakeClient()
+    bulk_apply(client, auth_resources, max_workers=1)
+    assert client.max_in_flight == 1
+
+
+def test_bulk_apply_retries(auth_resources):
+    """Test that transient errors are retried, and that other errors stop the next tiers."""
+    service_account = "ServiceAccount/volumes-sa"
+    client = FakeClient(errors={service_account: [api_error(429), api_error(503)]})
+    results = bulk_apply(client, auth_resources, backoff=0)
+    assert {result.name: result.attempts for result in results}[service_account] == 3
+    assert all(result.error is None for result in results)
+
+    # conflicts are not transient, they need a forced apply or another field manager to yield
+    for code in [409, 422]:
+        client = FakeClient(errors={service_account: [api_error(code)]})
+        results = bulk_apply(client, auth_resources, backoff=0)
+        assert [result.attempts for result in results if result.error] == [1]
+
+    client = FakeClient(errors={service_account: [api_error(422)]})
+    results = bulk_apply(client, auth_resources, backoff=0)
+    assert [result.name for result in results if result.error] == [service_account]
+    assert not any(name.startswith("ClusterRoleBinding/") for name, _, _ in client.applied)
+
+
+def test_kubernetes_component_reports_apply_errors(auth_resources):
+    """Test that a forbidden apply blocks the component, and other failures are raised."""
+    for error, expected_exception in [
+        (api_error(403), ErrorWithStatus),
+        (api_error(422), GenericCharmRuntimeError),
+    ]:
+        krh = MagicMock(resource_types={type(resource) for resource in auth_resources})
+        krh.render_manifests.return_value = auth_resources
+        krh.get_deployed_resources.return_value = []
+        krh.lightkube_client = FakeClient(errors={"ClusterRole/volumes-role": [error]})
+        component = MagicMock(_get_kubernetes_resource_handler=MagicMock(return_value=krh))
+
+        with pytest.raises(expected_exception) as exc_info:
+            KubeflowVolumesKubernetesComponent._configure_app_leader(component, None)
+        if expected_exception is ErrorWithStatus:
+            assert exc_info.value.status_type is BlockedStatus
+
+
+class FakeDeleteClient:
+    """Fake lightkube Client holding resources, whose first request in each thread waits for
+    `parties` threads to make theirs, so that deletes only complete if they run concurrently.
+    """
+
+    def __init__(self, resources=(), parties: int = 1, release: threading.Event = None):
+        self.resources = list(resources)
+        self.deleted = []
+        self.collections = []
+        self._barrier = threading.Barrier(parties, timeout=5)
+        self._release = release
+        self._thread = threading.local()
+
+    def _request(self):
+        if not getattr(self._thread, "started", False):
+            self._thread.started = True
+            self._barrier.wait()
+        if self._release is not None:
+            self._release.wait()
+
+    def list(self, res, namespace=None, labels=None):  # noqa: A003 (lightkube Client API)
+        self._request()
+        return [
+            MagicMock(metadata=ObjectMeta(name=name, namespace=resource_namespace))
+            for kind, name, resource_namespace, resource_labels in self.resources
+            if kind == res.__name__
+            and namespace in ("*", resource_namespace)
+            and labels.items() <= resource_labels.items()
+        ]
+
+    def delete(self, res, name, namespace=None, cascade=None):
+        self._request()
+        if name == "missing":
+            raise api_error(404)
+        self.deleted.append((res.__name__, name, namespace, cascade.value))
+
+    def deletecollection(self, res, namespace=None, cascade=None):
+        self._request()
+        self.collections.append((res.__name__, namespace, cascade.value))
+
+
+def test_bulk_delete():
+    """Test that targets are deleted concurrently, scoped by name, labels or namespace."""
+    labels = {"app.kubernetes.io/instance": "volumes-kubeflow"}
+    targets = [
+        DeleteTarget(ClusterRole, labels=labels),
+        DeleteTarget(RoleBinding, labels=labels),
+        DeleteTarget(Service, name="volumes", namespace="kubeflow"),
+        DeleteTarget(Service, name="missing", namespace="kubeflow"),
+        DeleteTarget(RoleBinding, namespace="shard"),
+    ]
+    client = FakeDeleteClient(
+        resources=[
+            ("ClusterRole", "volumes-role", None, labels),
+            ("ClusterRole", "other-role", None, {}),
+            ("RoleBinding", "volumes-a", "a", labels),
+            ("RoleBinding", "volumes-b", "b", labels),
+            ("RoleBinding", "other", "b", {}),
+        ],
+        # every target waits for the others, so a sequential delete would fail
+        parties=len(targets),
+    )
+
+    assert bulk_delete(client, targets) == []
+
+    assert sorted(client.deleted) == [
+        ("ClusterRole", "volumes-role", None, "Background"),
+        ("RoleBinding", "volumes-a", "a", "Background"),
+        ("RoleBinding", "volumes-b", "b", "Background"),
+        ("Service", "volumes", "kubeflow", "Background"),
+    ]
+    assert client.collections == [("RoleBinding", "shard", "Background")]
+
+
+def test_delete_target_requires_a_scope():
+    """Test that a target cannot select every resource of a type in the cluster."""
+    with pytest.raises(ValueError):
+        DeleteTarget(ClusterRole)
+    with pytest.raises(ValueError):
+        DeleteTarget(RoleBinding, labels={})
+
+
+def test_bulk_delete_timeout():
+    """Test that the deletes that did not complete within the timeout are reported."""
+    targets = [
+        DeleteTarget(ClusterRole, labels={"app": "volumes"}),
+        DeleteTarget(Service, name="volumes", namespace="x"),
+    ]
+    release = threading.Event()
+    client = FakeDeleteClient(release=release)
+
+    try:
+        assert bulk_delete(client, targets, timeout=0.01) == targets
+    finally:
+        release.set()
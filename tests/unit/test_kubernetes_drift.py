@@ -0,0 +1,205 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the Kubernetes drift watcher."""
+
+import json
+import queue
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from lightkube.models.meta_v1 import ManagedFieldsEntry, ObjectMeta
+from lightkube.resources.core_v1 import ServiceAccount
+from lightkube.resources.rbac_authorization_v1 import ClusterRole, RoleBinding
+from ops.testing import Harness
+
+import kubernetes_drift_watcher
+from charm import KubeflowVolumesOperator
+from components.kubernetes_components import ApplyResult
+from components.kubernetes_drift import DRIFT_WATCHER_SERVICE
+from kubernetes_drift_watcher import ResourceWatcher, collect, dispatch, drifted_resource
+
+
+def cluster_role(name: str, *managers: str, version: str = "1") -> ClusterRole:
+    """Returns a ClusterRole last changed by the latest of `managers`."""
+    managed_fields = [
+        ManagedFieldsEntry(manager=manager, time=datetime(2024, 1, i + 1, tzinfo=timezone.utc))
+        for i, manager in enumerate(managers)
+    ]
+    return ClusterRole(
+        metadata=ObjectMeta(name=name, managedFields=managed_fields, resourceVersion=version)
+    )
+
+
+@pytest.fixture()
+def harness(mocker, tmp_path):
+    """Returns a Harness of the leader unit, with the drift watcher enabled."""
+    mocker.patch("charm.TEMPLATE_CACHE_PATH", tmp_path / "template-cache")
+    mocker.patch("charm.CachedKubernetesServicePatch", lambda x, y, service_name: None)
+    mocker.patch("charm.lightkube.Client", return_value=MagicMock())
+    harness = Harness(KubeflowVolumesOperator)
+    harness.set_leader(True)
+    harness.update_config({"drift-watcher": True})
+    return harness
+
+
+def test_drifted_resource():
+    """Test that only modifications by other field managers and deletions are drift."""
+    assert drifted_resource("ADDED", cluster_role("role", "kubectl"), "lightkube") is None
+    assert (
+        drifted_resource("MODIFIED", cluster_role("role", "kubectl", "lightkube"), "lightkube")
+        is None
+    )
+    modified = cluster_role("role", "lightkube", "kubectl")
+    assert drifted_resource("MODIFIED", modified, "lightkube") == ("ClusterRole", "role", None)
+    service_account = ServiceAccount(metadata=ObjectMeta(name="sa", namespace="kubeflow"))
+    assert drifted_resource("DELETED", service_account, "lightkube") == (
+        "ServiceAccount",
+        "sa",
+        "kubeflow",
+    )
+
+
+def drained(drifted: queue.Queue) -> list:
+    """Returns the resources put on a queue."""
+    return [drifted.get_nowait() for _ in range(drifted.qsize())]
+
+
+def test_resource_watcher_watches_all_namespaces():
+    """Test that namespaced kinds are listed and watched in all the namespaces."""
+    client = MagicMock()
+    client.list.return_value = []
+    client.watch.return_value = []
+    labels = {"app": "volumes"}
+    ResourceWatcher(client, RoleBinding, labels, "lightkube", queue.Queue()).watch()
+    client.list.assert_called_once_with(RoleBinding, namespace="*", labels=labels)
+    assert client.watch.call_args.kwargs["namespace"] == "*"
+
+    client.reset_mock()
+    ResourceWatcher(client, ClusterRole, labels, "lightkube", queue.Queue()).watch()
+    client.list.assert_called_once_with(ClusterRole, namespace=None, labels=labels)
+
+
+def test_resource_watcher_restarts():
+    """Test that a restarted watch resumes, or lists again and reports the drift it missed."""
+    client = MagicMock()
+    drifted = queue.Queue()
+    watcher = ResourceWatcher(client, ClusterRole, {}, "lightkube", drifted)
+    client.list.return_value = [
+        cluster_role("kept", "lightkube"),
+        cluster_role("modified", "lightkube"),
+        cluster_role("deleted", "lightkube"),
+    ]
+    client.watch.return_value = [("MODIFIED", cluster_role("kept", "lightkube", version="2"))]
+    watcher.watch()
+    assert client.watch.call_args.kwargs["resource_version"] is None
+    assert drained(drifted) == []
+
+    # the watch is resumed from the last event
+    client.reset_mock()
+    client.watch.return_value = []
+    watcher.watch()
+    client.list.assert_not_called()
+    assert client.watch.call_args.kwargs["resource_version"] == "2"
+
+    # the resources changed while the watch could not be resumed are reported once listed again
+    watcher.resource_version = None
+    client.list.return_value = [
+        cluster_role("kept", "lightkube", version="2"),
+        cluster_role("modified", "lightkube", "kubectl", version="3"),
+    ]
+    watcher.watch()
+    assert drained(drifted) == [
+        ("ClusterRole", "deleted", None),
+        ("ClusterRole", "modified", None),
+    ]
+
+    # and so are the ones modified between the list and the watch
+    watcher.resource_version = None
+    client.watch.return_value = [
+        ("ADDED", cluster_role("kept", "lightkube", "kubectl", version="4")),
+        ("ADDED", cluster_role("added", "kubectl", version="5")),
+    ]
+    watcher.watch()
+    assert drained(drifted) == [("ClusterRole", "kept", None)]
+
+
+def test_collect_and_dispatch():
+    """Test that a burst of drift is reported once, by dispatching the kubernetes_drift event."""
+    drifted = queue.Queue()
+    for resource in [("ClusterRole", "b", None), ("ClusterRole", "a", None)] * 2:
+        drifted.put(resource)
+    resources = collect(drifted, debounce=0.01)
+    assert resources == [("ClusterRole", "a", None), ("ClusterRole", "b", None)]
+
+    with patch.object(kubernetes_drift_watcher.subprocess, "run") as run:
+        dispatch("volumes/0", "/charm", resources)
+    ((juju_exec, unit, command),), _ = run.call_args
+    assert (juju_exec, unit) == ("juju-exec", "volumes/0")
+    assert command.endswith("JUJU_DISPATCH_PATH=hooks/kubernetes_drift /charm/dispatch")
+    assert json.dumps(resources) in command
+
+
+def test_drift_event_repairs_drifted_resources(harness, monkeypatch):
+    """Test that the kubernetes_drift event only applies the resources that drifted."""
+    harness.begin()
+    component = harness.charm.kubernetes_resources.component
+    krh = MagicMock()
+    krh.render_manifests.return_value = [
+        cluster_role("volumes-role"),
+        cluster_role("volumes-ui-role"),
+        ServiceAccount(metadata=ObjectMeta(name="volumes-sa", namespace=harness.model.name)),
+    ]
+    component._get_kubernetes_resource_handler = MagicMock(return_value=krh)
+    drifted = [["ClusterRole", "volumes-role", None], ["ClusterRole", "unknown", None]]
+    monkeypatch.setenv("DRIFTED_RESOURCES", json.dumps(drifted))
+
+    with patch("components.kubernetes_components.bulk_apply", return_value=[]) as bulk_apply:
+        harness.charm.on.kubernetes_drift.emit()
+
+    (_, resources), kwargs = bulk_apply.call_args
+    assert [resource.metadata.name for resource in resources] == ["volumes-role"]
+    assert kwargs == {"force": True}
+
+    # a failed repair reconciles the component
+    failed = [ApplyResult(resources[0], attempts=1, error=MagicMock())]
+    with patch("components.kubernetes_components.bulk_apply", return_value=failed), patch.object(
+        harness.charm.charm_reconciler, "reconcile"
+    ) as reconcile:
+        harness.charm.on.kubernetes_drift.emit()
+    reconcile.assert_called_once()
+
+
+def test_drift_watcher_service(harness):
+    """Test that the watcher runs on the leader while enabled, and is stopped otherwise."""
+    with patch("components.kubernetes_drift.pebble.Client") as client_type:
+        client = client_type.return_value
+        harness.begin()
+        harness.charm.on.config_changed.emit()
+        (label, layer), _ = client.add_layer.call_args
+        service = layer["services"][DRIFT_WATCHER_SERVICE]
+        assert service["startup"] == "enabled"
+        assert service["environment"]["DRIFT_WATCHER_KINDS"] == (
+            "ClusterRole,ClusterRoleBinding,RoleBinding,ServiceAccount"
+        )
+        assert json.loads(service["environment"]["DRIFT_WATCHER_LABELS"]) == {
+            "app.kubernetes.io/instance": f"{harness.model.app.name}-{harness.model.name}",
+            "kubernetes-resource-handler-scope": "auth",
+        }
+        client.replan_services.assert_called_once()
+
+        # the running watcher is only replanned when its layer changed, or the pod was recreated
+        client.reset_mock()
+        harness.charm.on.update_status.emit()
+        client.add_layer.assert_not_called()
+        harness.charm.on.start.emit()
+        client.replan_services.assert_called_once()
+
+        client.get_services.return_value = [MagicMock(is_running=MagicMock(return_value=True))]
+        harness.update_config({"drift-watcher": False})
+        client.stop_services.assert_called_once_with([DRIFT_WATCHER_SERVICE])
+
+        # a disabled watcher that was never started is left alone
+        client.reset_mock()
+        harness.charm.on.update_status.emit()
+        client.add_layer.assert_not_called()
@@ -0,0 +1,26 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the log forwarder of the charm."""
+
+import json
+from unittest.mock import MagicMock
+
+from components.log_forwarder import KubeflowVolumesLogForwarder
+
+
+def test_log_forwarder_prefers_app_endpoint():
+    """Test that an application-level endpoint advertised by Loki is used over the units."""
+    relation = MagicMock()
+    relation.app.name = "loki"
+    units = {"loki/3": "http://loki-3/push", "loki/10": "http://loki-10/push"}
+
+    relation.data = {relation.app: {}}
+    assert KubeflowVolumesLogForwarder._select_app_endpoint(relation, units) == units
+
+    relation.data = {relation.app: {"endpoint": "not json"}}
+    assert KubeflowVolumesLogForwarder._select_app_endpoint(relation, units) == units
+
+    relation.data = {relation.app: {"endpoint": json.dumps({"url": "http://ingress/push"})}}
+    assert KubeflowVolumesLogForwarder._select_app_endpoint(relation, units) == {
+        "loki": "http://ingress/push"
+    }
@@ -1,14 +1,17 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
-from unittest.mock import MagicMock, patch
+import json
+from unittest.mock import ANY, MagicMock, patch
 
 import pytest
 import yaml
 from charmed_kubeflow_chisme.testing import add_sdi_relation_to_harness
-from ops.model import ActiveStatus
+from lightkube.resources.core_v1 import Namespace
+from ops.model import ActiveStatus, BlockedStatus
 from ops.testing import Harness
 
 from charm import KubeflowVolumesOperator
+from components.pebble_components import GUNICORN_CONFIG_DESTINATION_PATH
 
 
 @pytest.fixture
@@ -16,11 +19,18 @@ def harness():
     return Harness(KubeflowVolumesOperator)
 
 
+@pytest.fixture(autouse=True)
+def template_cache_path(mocker, tmp_path):
+    """Keeps the template cache of the charm in a temporary directory."""
+    mocker.patch("charm.TEMPLATE_CACHE_PATH", tmp_path / "template-cache")
+    yield tmp_path / "template-cache"
+
+
 @pytest.fixture()
 def mocked_kubernetes_service_patch(mocker):
-    """Mocks the KubernetesServicePatch for the charm."""
+    """Mocks the CachedKubernetesServicePatch for the charm."""
     mocked_kubernetes_service_patch = mocker.patch(
-        "charm.KubernetesServicePatch", lambda x, y, service_name: None
+        "charm.CachedKubernetesServicePatch", lambda x, y, service_name: None
     )
     yield mocked_kubernetes_service_patch
 
@@ -33,6 +43,21 @@ def mocked_lightkube_client(mocker):
     yield mocked_lightkube_client
 
 
+def namespaces(*names: str) -> list:
+    """Returns mocked Namespaces with the given names, as listed by the Lightkube Client."""
+    result = []
+    for name in names:
+        namespace = MagicMock()
+        namespace.metadata.name = name
+        result.append(namespace)
+    return result
+
+
+def list_namespaces(*names: str):
+    """Returns a mocked Client.list listing the given Namespaces, and no other resources."""
+    return lambda resource, **_: namespaces(*names) if resource is Namespace else []
+
+
 def render_ingress_data(service, port) -> dict:
     """Returns typical data for the ingress relation."""
     return {
@@ -45,9 +70,14 @@ def render_ingress_data(service, port) -> dict:
 
 def test_log_forwarding(harness, mocked_lightkube_client, mocked_kubernetes_service_patch):
     """Test LogForwarder initialization."""
-    with patch("charm.LogForwarder") as mock_logging:
+    with patch("charm.KubeflowVolumesLogForwarder") as mock_logging:
         harness.begin()
-        mock_logging.assert_called_once_with(charm=harness.charm)
+        mock_logging.assert_called_once_with(
+            charm=harness.charm,
+            extra_labels={"log_format": "text"},
+            refresh_event=ANY,
+            one_per_app=False,
+        )
 
 
 def test_not_leader(harness, mocked_lightkube_client, mocked_kubernetes_service_patch):
@@ -113,6 +143,34 @@ def test_ingress_relation_with_related_app(
     assert_relation_data_send_as_expected(harness, expected_relation_data, relation_ids_to_assert)
 
 
+def test_unchanged_relation_data_is_not_rewritten(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that the ingress versions and data are only written when they changed."""
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.leadership_gate.get_status = MagicMock(return_value=ActiveStatus())
+    relation_metadata = add_sdi_relation_to_harness(harness, "ingress", other_app="o1", data={})
+
+    with patch.object(
+        harness._backend, "update_relation_data", wraps=harness._backend.update_relation_data
+    ) as update_relation_data:
+        harness.charm.on.config_changed.emit()
+        harness.charm.on.upgrade_charm.emit()
+
+    assert relation_metadata.rel_id not in {
+        call.args[0] for call in update_relation_data.call_args_list
+    }
+    assert_relation_data_send_as_expected(
+        harness,
+        {
+            "_supported_versions": ["v1"],
+            "data": render_ingress_data(service=harness.model.app.name, port=5000),
+        },
+        [relation_metadata.rel_id],
+    )
+
+
 def assert_relation_data_send_as_expected(harness, expected_relation_data, rel_ids_to_assert):
     """Asserts that we have sent the expected data to the given relations."""
     # Assert on the data we sent out to the other app for each relation.
@@ -154,3 +212,435 @@ def test_pebble_services_running(
     )
     assert environment["BACKEND_MODE"] == harness.charm.config.get("backend-mode")
     assert environment["VOLUME_VIEWER_IMAGE"] == harness.charm.config.get("volume-viewer-image")
+    assert environment["APP_PREFIX"] == "/volumes"
+
+
+def test_shard_mode_rbac(harness, mocked_lightkube_client, mocked_kubernetes_service_patch):
+    """Test that in shard mode the workload permissions are bound only in the served namespaces."""
+    # Arrange
+    harness.update_config({"shard-namespaces": "team-a, team-b"})
+    mocked_lightkube_client.list.side_effect = list_namespaces("kubeflow", "team-a", "team-b")
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.leadership_gate.get_status = MagicMock(return_value=ActiveStatus())
+
+    # Act
+    harness.charm.on.install.emit()
+
+    # Assert
+    applied = [call.kwargs["obj"] for call in mocked_lightkube_client.apply.call_args_list]
+    role_bindings = [obj for obj in applied if obj.kind == "RoleBinding"]
+    assert sorted(obj.metadata.namespace for obj in role_bindings) == ["team-a", "team-b"]
+    assert all(obj.roleRef.name == f"{harness.model.app.name}-role" for obj in role_bindings)
+    cluster_role_bindings = [obj for obj in applied if obj.kind == "ClusterRoleBinding"]
+    assert [obj.roleRef.name for obj in cluster_role_bindings] == [
+        f"{harness.model.app.name}-cluster-role"
+    ]
+
+
+def test_shard_mode_namespace_selector(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that the namespaces matching the shard label selector are served."""
+    harness.update_config(
+        {"shard-namespaces": "team-a", "shard-namespace-selector": "shard=one, tier=gold"}
+    )
+    mocked_lightkube_client.list.side_effect = lambda resource, labels=None: (
+        namespaces("team-c") if labels else namespaces("team-a", "team-c", "team-d")
+    )
+    harness.begin()
+
+    context = harness.charm._get_auth_manifests_context()
+
+    assert context["shard_mode"] is True
+    assert context["shard_namespaces"] == ["team-a", "team-c"]
+    assert [call.kwargs.get("labels") for call in mocked_lightkube_client.list.call_args_list] == [
+        None,
+        {"shard": "one", "tier": "gold"},
+    ]
+
+
+def test_shard_mode_skips_missing_namespaces(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that no RoleBinding is applied in a listed shard namespace that does not exist."""
+    harness.update_config({"shard-namespaces": "team-a,team-b"})
+    mocked_lightkube_client.list.side_effect = list_namespaces("team-a")
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.leadership_gate.get_status = MagicMock(return_value=ActiveStatus())
+
+    harness.charm.on.install.emit()
+
+    applied = [call.kwargs["obj"] for call in mocked_lightkube_client.apply.call_args_list]
+    assert [obj.metadata.namespace for obj in applied if obj.kind == "RoleBinding"] == ["team-a"]
+
+
+def test_invalid_shard_namespaces(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that shard namespaces with invalid names block the charm before anything is applied."""
+    harness.update_config({"shard-namespaces": "team-a, Team_B, -c"})
+    harness.set_leader(True)
+    harness.begin()
+
+    harness.charm.on.install.emit()
+
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "[config:shard] Invalid shard-namespaces: Team_B, -c (expected lowercase alphanumerics "
+        "and '-', of at most 63 characters)"
+    )
+    mocked_lightkube_client.apply.assert_not_called()
+
+
+def test_invalid_shard_namespace_selector(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that an invalid shard label selector blocks the charm before anything is applied."""
+    harness.update_config({"shard-namespace-selector": "shard"})
+    harness.set_leader(True)
+    harness.begin()
+
+    harness.charm.on.install.emit()
+
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "[config:shard] Invalid shard-namespace-selector: Invalid label selector term 'shard', "
+        "expected 'key=value'."
+    )
+    mocked_lightkube_client.apply.assert_not_called()
+
+
+def test_cluster_role_binding_subject_namespace(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that outside of shard mode the workload is bound to its ServiceAccount's namespace."""
+    harness.set_model_name("team-volumes")
+    harness.set_leader(True)
+    harness.begin()
+
+    harness.charm.on.install.emit()
+
+    applied = [call.kwargs["obj"] for call in mocked_lightkube_client.apply.call_args_list]
+    bindings = [obj for obj in applied if obj.kind == "ClusterRoleBinding"]
+    assert bindings
+    assert {subject.namespace for obj in bindings for subject in obj.subjects} == {"team-volumes"}
+
+
+def test_shard_mode_ingress_data(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that in shard mode the web app is served under a prefix of its own, with the shard."""
+    harness.update_config({"shard-namespaces": "team-a,team-b", "shard-namespace-selector": ""})
+    harness.set_leader(True)
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    harness.charm.leadership_gate.get_status = MagicMock(return_value=ActiveStatus())
+    harness.charm.kubernetes_resources.get_status = MagicMock(return_value=ActiveStatus())
+    prefix = f"/volumes/{harness.model.app.name}"
+
+    relation_metadata = add_sdi_relation_to_harness(harness, "ingress", other_app="o1", data={})
+    dashboard_relation_id = harness.add_relation("dashboard-links", "kubeflow-dashboard")
+
+    relation_data = harness.get_relation_data(relation_metadata.rel_id, harness.model.app)
+    data = yaml.safe_load(relation_data["data"])
+    assert (data["prefix"], data["rewrite"]) == (prefix, "/")
+    assert data["shard"] == {
+        "namespaces": ["team-a", "team-b"],
+        "namespace_selector": "",
+    }
+    # the web app builds its links with the same prefix, as does the dashboard sidebar
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    environment = container.get_plan().services["kubeflow-volumes"].environment
+    assert environment["APP_PREFIX"] == prefix
+    dashboard_data = harness.get_relation_data(dashboard_relation_id, harness.model.app)
+    assert [link["link"] for link in json.loads(dashboard_data["dashboard_links"])] == [
+        f"{prefix}/"
+    ]
+
+
+def test_access_log_configuration(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that the access log options are passed to gunicorn through its config file."""
+    # Arrange
+    harness.update_config(
+        {
+            "access-log": True,
+            "access-log-sample-rate": 0.1,
+            "access-log-exclude-paths": "/healthz,/static/",
+        }
+    )
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    harness.charm.leadership_gate.get_status = MagicMock(return_value=ActiveStatus())
+    harness.charm.kubernetes_resources.get_status = MagicMock(return_value=ActiveStatus())
+
+    # Act
+    harness.charm.on.install.emit()
+
+    # Assert
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    service = container.get_plan().services["kubeflow-volumes"]
+    assert f"-c {GUNICORN_CONFIG_DESTINATION_PATH}" in service.command
+    assert "--access-logfile" not in service.command
+    assert service.environment["ACCESS_LOG_ENABLED"] == "true"
+    assert service.environment["ACCESS_LOG_SAMPLE_RATE"] == "0.1"
+    assert service.environment["ACCESS_LOG_EXCLUDE_PATHS"] == "/healthz,/static/"
+    gunicorn_config = container.pull(GUNICORN_CONFIG_DESTINATION_PATH).read()
+    assert "logger_class = FilteredAccessLogger" in gunicorn_config
+
+
+def test_json_access_log_format(harness, mocked_lightkube_client, mocked_kubernetes_service_patch):
+    """Test that the JSON access log format is set on gunicorn and on the forwarded logs."""
+    # Arrange
+    harness.set_leader(True)
+    harness.update_config({"access-log-format": "json"})
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    harness.charm.kubernetes_resources.get_status = MagicMock(return_value=ActiveStatus())
+    relation_id = harness.add_relation("logging", "loki")
+    harness.add_relation_unit(relation_id, "loki/0")
+
+    # Act
+    harness.update_relation_data(
+        relation_id,
+        "loki/0",
+        {"endpoint": json.dumps({"url": "http://loki:3100/loki/api/v1/push"})},
+    )
+    harness.charm.on.config_changed.emit()
+
+    # Assert
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    plan = container.get_plan()
+    assert plan.services["kubeflow-volumes"].environment["ACCESS_LOG_FORMAT"] == "json"
+    assert plan.log_targets["loki/0"].labels["log_format"] == "json"
+
+
+def test_invalid_access_log_format(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that an unknown access log format blocks the charm, without reconfiguring gunicorn."""
+    # Arrange
+    harness.set_leader(True)
+    harness.update_config({"access-log-format": "xml"})
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    harness.charm.kubernetes_resources.get_status = MagicMock(return_value=ActiveStatus())
+
+    # Act
+    harness.charm.on.install.emit()
+
+    # Assert
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "[container:kubeflow-volumes] Invalid access-log-format 'xml', expected one of: text, json"
+    )
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    assert "kubeflow-volumes" not in container.get_plan().services
+
+
+def test_log_forwarding_updates_plan_only_on_change(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that the log targets are updated with at most one layer, and only when they change."""
+    # Arrange
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    relation_id = harness.add_relation("logging", "loki")
+    for unit in range(3):
+        harness.add_relation_unit(relation_id, f"loki/{unit}")
+        harness.update_relation_data(
+            relation_id,
+            f"loki/{unit}",
+            {"endpoint": json.dumps({"url": f"http://loki-{unit}:3100/loki/api/v1/push"})},
+        )
+
+    with patch.object(type(container), "add_layer", autospec=True) as mock_add_layer:
+        # Act: an event that does not change the endpoints
+        harness.charm.on.config_changed.emit()
+
+        # Assert
+        mock_add_layer.assert_not_called()
+
+    # Act: a Loki unit departs
+    with patch.object(
+        type(container), "add_layer", autospec=True, side_effect=type(container).add_layer
+    ) as mock_add_layer:
+        harness.remove_relation_unit(relation_id, "loki/2")
+
+        # Assert
+        mock_add_layer.assert_called_once()
+    log_targets = container.get_plan().log_targets
+    assert log_targets["loki/0"].services == ["all"]
+    assert log_targets["loki/1"].services == ["all"]
+    assert log_targets["loki/2"].services == ["-all"]
+
+
+def test_reconcile_only_executes_components_with_changed_inputs(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that components are only executed when their declared inputs changed."""
+    # Arrange
+    harness.set_leader(True)
+    harness.begin()
+    components = {
+        "kubernetes:auth": harness.charm.kubernetes_resources.component,
+        "relation:ingress": harness.charm.ingress_relation.component,
+        "container:kubeflow-volumes": harness.charm.kubeflow_volumes_container.component,
+    }
+    for component in components.values():
+        component.configure_charm = MagicMock()
+        component.get_status = MagicMock(return_value=ActiveStatus())
+
+    def executed():
+        executed = {
+            name for name, component in components.items() if component.configure_charm.called
+        }
+        for component in components.values():
+            component.configure_charm.reset_mock()
+        return executed
+
+    # Act and assert: the first reconcile executes everything
+    harness.charm.on.config_changed.emit()
+    assert executed() == set(components)
+
+    # nothing changed
+    harness.charm.on.config_changed.emit()
+    harness.add_relation("dashboard-links", "kubeflow-dashboard")
+    assert executed() == set()
+
+    # only the Pebble service reads the access log configuration
+    harness.update_config({"access-log-format": "json"})
+    assert executed() == {"container:kubeflow-volumes"}
+
+    # skipped components are reported Active without being asked for their status, which may
+    # take API requests, and the executed ones are asked once
+    for component in components.values():
+        component.get_status.reset_mock()
+    harness.update_config({"access-log-format": "text"})
+    assert executed() == {"container:kubeflow-volumes"}
+    asked = {name: component.get_status.call_count for name, component in components.items()}
+    assert asked == {"kubernetes:auth": 0, "relation:ingress": 0, "container:kubeflow-volumes": 1}
+
+    # update-status only executes the components that drifted: the Pebble service of the
+    # workload container is not running
+    harness.charm.on.update_status.emit()
+    assert executed() == {"container:kubeflow-volumes"}
+
+    # the workload container restarted with an empty plan
+    harness.container_pebble_ready("kubeflow-volumes")
+    assert executed() == {"container:kubeflow-volumes"}
+    harness.container_pebble_ready("kubeflow-volumes")
+    assert executed() == {"container:kubeflow-volumes"}
+
+    # upgrades execute everything
+    harness.charm.on.upgrade_charm.emit()
+    assert executed() == set(components)
+
+
+def test_shard_namespaces_labelled_later_are_reconciled(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that update-status reconciles the auth resources when the shard namespaces change."""
+    # Arrange
+    harness.update_config({"shard-namespace-selector": "shard=one"})
+    harness.set_leader(True)
+    harness.begin()
+    component = harness.charm.kubernetes_resources.component
+    component.configure_charm = MagicMock()
+    component.get_status = MagicMock(return_value=ActiveStatus())
+    harness.charm.on.config_changed.emit()
+    component.configure_charm.reset_mock()
+
+    # Act and assert: nothing changed
+    harness.charm.on.update_status.emit()
+    component.configure_charm.assert_not_called()
+
+    # a namespace was labelled with the selector
+    mocked_lightkube_client.list.return_value = namespaces("team-c")
+    harness.charm.on.update_status.emit()
+    component.configure_charm.assert_called_once()
+
+
+def test_remove_tears_down_resources(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that the resources are deleted on remove only when the application is removed."""
+    harness.set_leader(True)
+    harness.begin()
+
+    with patch("components.kubernetes_components.bulk_delete", return_value=[]) as bulk_delete:
+        harness.set_planned_units(1)
+        harness.charm.on.remove.emit()
+        bulk_delete.assert_not_called()
+
+        harness.set_planned_units(0)
+        harness.charm.on.remove.emit()
+    (_, targets), _ = bulk_delete.call_args
+    labels = {
+        "app.kubernetes.io/instance": f"kubeflow-volumes-{harness.model.name}",
+        "kubernetes-resource-handler-scope": "auth",
+    }
+    # every target is scoped by the labels of the application, or by name and namespace
+    assert sorted(
+        (target.resource_type.__name__, target.name, target.namespace, target.labels)
+        for target in targets
+    ) == [
+        ("ClusterRole", None, None, labels),
+        ("ClusterRoleBinding", None, None, labels),
+        ("RoleBinding", None, None, labels),
+        ("Service", harness.model.app.name, harness.model.name, None),
+        ("ServiceAccount", None, None, labels),
+    ]
+
+
+def test_remove_tears_down_shard_pvcviewers(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that PVCViewers are only deleted in the namespaces of the shard."""
+    harness.set_leader(True)
+    harness.update_config({"shard-namespaces": "team-a,team-b"})
+    mocked_lightkube_client.list.return_value = namespaces("team-a", "team-b")
+    harness.begin()
+
+    targets = harness.charm._get_teardown_targets()
+
+    assert {
+        (target.resource_type.__name__, target.name, target.namespace, target.labels)
+        for target in targets
+        if target.resource_type.__name__ == "PVCViewer"
+    } == {("PVCViewer", None, "team-a", None), ("PVCViewer", None, "team-b", None)}
+
+
+def test_log_forwarding_one_per_app(
+    harness, mocked_lightkube_client, mocked_kubernetes_service_patch
+):
+    """Test that logs go once to the application endpoint of Loki, when enabled and advertised."""
+    # Arrange
+    harness.update_config({"log-forwarding-one-per-app": True})
+    harness.begin()
+    harness.set_can_connect("kubeflow-volumes", True)
+    container = harness.charm.unit.get_container("kubeflow-volumes")
+    relation_id = harness.add_relation("logging", "loki")
+    for unit in range(2):
+        harness.add_relation_unit(relation_id, f"loki/{unit}")
+        harness.update_relation_data(
+            relation_id,
+            f"loki/{unit}",
+            {"endpoint": json.dumps({"url": f"http://loki-{unit}:3100/loki/api/v1/push"})},
+        )
+
+    # Assert: without an application endpoint, the logs are sent to every unit
+    assert set(container.get_plan().log_targets) == {"loki/0", "loki/1"}
+
+    # Act
+    harness.update_relation_data(
+        relation_id, "loki", {"endpoint": json.dumps({"url": "http://loki:3100/push"})}
+    )
+
+    # Assert
+    log_targets = container.get_plan().log_targets
+    assert log_targets["loki"].location == "http://loki:3100/push"
+    assert log_targets["loki"].services == ["all"]
+    assert log_targets["loki/0"].services == ["-all"]
+    assert log_targets["loki/1"].services == ["-all"]
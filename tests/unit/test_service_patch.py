@@ -0,0 +1,70 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the CachedKubernetesServicePatch."""
+
+from unittest.mock import MagicMock, mock_open, patch
+
+from lightkube.models.core_v1 import ServicePort, ServiceSpec
+from lightkube.resources.core_v1 import Service
+from ops import CharmBase
+from ops.testing import Harness
+
+from components.service_patch import CachedKubernetesServicePatch
+
+
+class ServicePatchCharm(CharmBase):
+    """Charm patching its Service on install, start, upgrade, update-status and config-changed."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.service_patcher = CachedKubernetesServicePatch(
+            self, [ServicePort(5000, name="http")], refresh_event=self.on.config_changed
+        )
+
+
+def test_service_is_only_patched_when_changed():
+    """Test that an unchanged Service is neither fetched nor patched, but on start or upgrade."""
+    client = MagicMock()
+    client.get.return_value = Service(spec=ServiceSpec(ports=[ServicePort(65535)]))
+    client.list.return_value = []
+    harness = Harness(ServicePatchCharm, meta="name: test")
+    namespace_file = mock_open(read_data="kubeflow\n")
+
+    with patch("components.service_patch.Client", return_value=client), patch(
+        "charms.observability_libs.v1.kubernetes_service_patch.Client", return_value=client
+    ), patch("builtins.open", namespace_file):
+        harness.begin()
+        service_patcher = harness.charm.service_patcher
+
+        def requests() -> int:
+            count = client.get.call_count + client.patch.call_count
+            client.reset_mock()
+            return count
+
+        harness.charm.on.install.emit()
+        assert requests() == 2
+
+        harness.charm.on.update_status.emit()
+        harness.charm.on.config_changed.emit()
+        assert requests() == 0
+        assert service_patcher.is_patched()
+        assert requests() == 0
+
+        # the desired ports changed
+        service_patcher.service.spec.ports[0].port = 5001
+        harness.charm.on.config_changed.emit()
+        assert requests() == 2
+
+        # the service edited out of band is repaired when the charm starts again
+        harness.charm.on.update_status.emit()
+        assert requests() == 0
+        harness.charm.on.start.emit()
+        assert requests() == 2
+
+        # the service is validated again with the upgraded charm code
+        harness.charm.on.upgrade_charm.emit()
+        assert requests() == 2
+
+    # the namespace is read once, then kept in the charm's state
+    namespace_file.assert_called_once()
+    assert service_patcher._namespace == "kubeflow"
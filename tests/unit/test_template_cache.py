@@ -0,0 +1,95 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Unit tests for the TemplateCache."""
+
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from charmed_kubeflow_chisme.components import ContainerFileTemplate
+from charmed_kubeflow_chisme.kubernetes import KubernetesResourceHandler
+from lightkube import codecs
+
+from components import template_cache
+from components.template_cache import (
+    CachedContainerFileTemplate,
+    CachedKubernetesResourceHandler,
+    TemplateCache,
+)
+
+AUTH_MANIFESTS = "src/templates/auth_manifests.yaml.j2"
+CONTEXT = {"app_name": "volumes", "namespace": "kubeflow", "shard_mode": False}
+
+
+def test_render_manifests_is_cached(tmp_path, mocker):
+    """Test that unchanged renders skip both the Jinja compilation and the YAML parsing."""
+    expected = codecs.load_all_yaml(
+        TemplateCache(tmp_path / "reference").render(AUTH_MANIFESTS, CONTEXT)
+    )
+    load_all_yaml = mocker.spy(template_cache.codecs, "load_all_yaml")
+    get_template = mocker.spy(template_cache.jinja2.Environment, "get_template")
+
+    assert (
+        TemplateCache(tmp_path / "cache").render_manifests([AUTH_MANIFESTS], CONTEXT) == expected
+    )
+    assert (load_all_yaml.call_count, get_template.call_count) == (1, 1)
+    assert list((tmp_path / "cache" / "bytecode").iterdir())
+
+    # in a later hook
+    assert (
+        TemplateCache(tmp_path / "cache").render_manifests([AUTH_MANIFESTS], CONTEXT) == expected
+    )
+    assert (load_all_yaml.call_count, get_template.call_count) == (1, 1)
+
+    # with another context
+    context = {**CONTEXT, "namespace": "other"}
+    resources = TemplateCache(tmp_path / "cache").render_manifests([AUTH_MANIFESTS], context)
+    assert resources != expected
+    assert (load_all_yaml.call_count, get_template.call_count) == (2, 2)
+
+
+def test_render_is_invalidated_by_template_changes(tmp_path):
+    """Test that a changed template is rendered again, with the same context."""
+    template = tmp_path / "template.j2"
+    template.write_text("name: {{ app_name }}\n")
+    cache = TemplateCache(tmp_path / "cache")
+    assert cache.render(template, CONTEXT) == "name: volumes"
+
+    template.write_text("namespace: {{ namespace }}\n")
+    assert TemplateCache(tmp_path / "cache").render(template, CONTEXT) == "namespace: kubeflow"
+
+
+def test_cached_resource_handler_labels(tmp_path):
+    """Test that the handler labels the manifests as KubernetesResourceHandler, when cached too."""
+    labels = {"app.kubernetes.io/instance": "volumes-kubeflow"}
+    handler = KubernetesResourceHandler(
+        "volumes", [AUTH_MANIFESTS], CONTEXT, labels=labels, lightkube_client=MagicMock()
+    )
+    expected = handler.render_manifests()
+
+    for _ in range(2):
+        cached_handler = CachedKubernetesResourceHandler(
+            "volumes",
+            [AUTH_MANIFESTS],
+            CONTEXT,
+            labels=labels,
+            lightkube_client=MagicMock(),
+            template_cache=TemplateCache(tmp_path),
+        )
+        resources = cached_handler.render_manifests()
+        assert resources == expected
+        assert all(resource.metadata.labels.items() >= labels.items() for resource in resources)
+
+
+def test_cached_container_file_template(tmp_path):
+    """Test that files pushed to the container are rendered as by ContainerFileTemplate."""
+    for source in [
+        Path("src/templates/viewer-spec.yaml"),
+        Path("src/templates/gunicorn_config.py"),
+    ]:
+        template = ContainerFileTemplate(source_template_path=source, destination_path="/file")
+        cached_template = CachedContainerFileTemplate(
+            source_template_path=source,
+            destination_path="/file",
+            template_cache=TemplateCache(tmp_path),
+        )
+        assert cached_template.render_source_template() == template.render_source_template()